@@ -0,0 +1,95 @@
+import os
+import threading
+
+
+CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+JOURNAL_PATH = os.path.join(CURRENT_DIR_PATH, 'crawl_journal.tsv')
+
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# lines buffered before they are written to the journal file
+FLUSH_EVERY = 100
+
+
+class CrawlJournal:
+    # append only progress journal, one "status<TAB>imdb_id" line per finished id.
+    # the id list itself is never rewritten, resuming only replays this file.
+
+    def __init__(self, _journal_path=JOURNAL_PATH, retry_failed=False):
+        self.journal_path = _journal_path
+        self.retry_failed = retry_failed
+        self.counts = {DONE: 0, FAILED: 0, SKIPPED: 0}
+        self._finished = set()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._replay()
+        self._file = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _replay(self):
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, 'r', encoding='utf-8') as file:
+            for _line in file:
+                _status, _, _imdb_id = _line.rstrip('\n').partition('\t')
+                # a crash can leave a half written last line
+                if _status not in self.counts or not _imdb_id:
+                    continue
+                self.counts[_status] += 1
+                if _status == FAILED and self.retry_failed:
+                    self._finished.discard(_imdb_id)
+                    continue
+                self._finished.add(_imdb_id)
+
+    def is_finished(self, _imdb_id):
+        return _imdb_id in self._finished
+
+    def pending(self, _imdb_ids):
+        # lazily yields the ids that still have to be crawled
+        return (_imdb_id for _imdb_id in _imdb_ids if _imdb_id not in self._finished)
+
+    def record(self, _status, _imdb_id):
+        with self._lock:
+            self._finished.add(_imdb_id)
+            self.counts[_status] += 1
+            self._buffer.append(f'{_status}\t{_imdb_id}\n')
+            if len(self._buffer) >= FLUSH_EVERY:
+                self._flush()
+
+    def done(self, _imdb_id):
+        self.record(DONE, _imdb_id)
+
+    def failed(self, _imdb_id):
+        self.record(FAILED, _imdb_id)
+
+    def skipped(self, _imdb_id):
+        self.record(SKIPPED, _imdb_id)
+
+    def on_commit(self, _rows):
+        # DatabaseWriter callback, an id is only done once its row is committed
+        for _statement, _parameters in _rows:
+            self.done(_parameters[0])
+
+    def _flush(self):
+        self._file.write(''.join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+if __name__ == '__main__':
+    _journal = CrawlJournal()
+    print(f'{JOURNAL_PATH}: {_journal.counts}')
+    _journal.close()
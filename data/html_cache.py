@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+HTML_CACHE_PATH = os.path.join(CURRENT_DIR_PATH, 'html_cache')
+COMPRESSION_LEVEL = 6
+
+my_logger = logging.getLogger(__name__)
+
+
+class HtmlCache:
+    # content addressed store of fetched pages.
+    # every page is gzipped once under objects/<sha256[:2]>/<sha256>.gz, identical pages share a file,
+    # index.db maps (imdb_id, fetched_at) to the sha256 of the page fetched at that time.
+
+    def __init__(self, _cache_path=HTML_CACHE_PATH):
+        self.cache_path = _cache_path
+        self.objects_path = os.path.join(_cache_path, 'objects')
+        os.makedirs(self.objects_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(_cache_path, 'index.db'), check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages (imdb_id TEXT NOT NULL, fetched_at INTEGER NOT NULL, '
+            'sha256 TEXT NOT NULL, size INTEGER, PRIMARY KEY (imdb_id, fetched_at))')
+        self._connection.commit()
+
+    def _object_path(self, _sha256):
+        return os.path.join(self.objects_path, _sha256[:2], f'{_sha256}.gz')
+
+    def store(self, _imdb_id, _html, fetched_at=None):
+        _content = _html.encode('utf-8') if isinstance(_html, str) else _html
+        _sha256 = hashlib.sha256(_content).hexdigest()
+        _path = self._object_path(_sha256)
+        if not os.path.isfile(_path):
+            os.makedirs(os.path.dirname(_path), exist_ok=True)
+            # written under a temporary name so a crash never leaves a truncated object
+            _temp_path = f'{_path}.{threading.get_ident()}.tmp'
+            with open(_temp_path, 'wb') as file:
+                file.write(gzip.compress(_content, COMPRESSION_LEVEL))
+            os.replace(_temp_path, _path)
+        _fetched_at = int(fetched_at if fetched_at is not None else time.time())
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                                     (_imdb_id, _fetched_at, _sha256, len(_content)))
+            self._connection.commit()
+        return _sha256
+
+    def _read_object(self, _sha256):
+        with open(self._object_path(_sha256), 'rb') as file:
+            return gzip.decompress(file.read()).decode('utf-8')
+
+    def load(self, _imdb_id, fetched_at=None):
+        # latest page of the id, or the one fetched at fetched_at
+        with self._lock:
+            if fetched_at is None:
+                _row = self._connection.execute(
+                    'SELECT sha256 FROM pages WHERE imdb_id = ? ORDER BY fetched_at DESC LIMIT 1',
+                    (_imdb_id,)).fetchone()
+            else:
+                _row = self._connection.execute(
+                    'SELECT sha256 FROM pages WHERE imdb_id = ? AND fetched_at = ?',
+                    (_imdb_id, int(fetched_at))).fetchone()
+        if not _row:
+            return None
+        return self._read_object(_row[0])
+
+    def iter_latest(self):
+        # yields (imdb_id, html, fetched_at) for the latest page of every cached id
+        # own connection, the index is streamed instead of loaded in memory
+        _connection = sqlite3.connect(os.path.join(self.cache_path, 'index.db'), check_same_thread=False)
+        try:
+            _rows = _connection.execute(
+                'SELECT imdb_id, sha256, fetched_at FROM pages p WHERE fetched_at = '
+                '(SELECT MAX(fetched_at) FROM pages WHERE imdb_id = p.imdb_id) ORDER BY imdb_id')
+            for _imdb_id, _sha256, _fetched_at in _rows:
+                try:
+                    yield _imdb_id, self._read_object(_sha256), _fetched_at
+                except (OSError, EOFError) as e:
+                    my_logger.warn(f'{_imdb_id}: cached page unreadable, {e!r}')
+        finally:
+            _connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(DISTINCT imdb_id) FROM pages').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+if __name__ == '__main__':
+    _cache = HtmlCache()
+    print(f'{HTML_CACHE_PATH}: {len(_cache)} ids cached')
+    _cache.close()
@@ -1,37 +1,125 @@
 import os
-import re
 import numpy as np
+import pandas as pd
 import pickle as pkl
 
 
 CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+IMDB_DATA_PATH = os.path.join(CURRENT_DIR_PATH, 'data.tsv')
+# legacy pickled list of 'ttXXXXXXX' strings, converted to ID_CACHE_PATH on first load
 ID_DUMP_PATH = os.path.join(CURRENT_DIR_PATH, 'imdb_ids_dump')
+# packed uint32 tt numbers, 4 bytes per id, memory mapped on load
+ID_CACHE_PATH = os.path.join(CURRENT_DIR_PATH, 'imdb_ids.npy')
+# one uint8 titleType code per id, same order as ID_CACHE_PATH
+TITLE_TYPE_CACHE_PATH = os.path.join(CURRENT_DIR_PATH, 'imdb_title_types.npy')
+# rows of data.tsv parsed per chunk
+CHUNK_SIZE = 1_000_000
+ITER_BLOCK_SIZE = 65_536
+
+# titleType values of title.basics, the index is the code stored in TITLE_TYPE_CACHE_PATH
+TITLE_TYPES = ('movie', 'short', 'tvMovie', 'tvSeries', 'tvMiniSeries', 'tvSpecial', 'tvShort',
+               'video', 'videoGame', 'tvEpisode', 'tvPilot')
+UNKNOWN_TITLE_TYPE = 255
+# everything get_details can store, episodes and video games are discarded after the download anyway
+DEFAULT_TITLE_TYPES = ('movie', 'short', 'tvMovie', 'tvSeries', 'tvMiniSeries', 'tvSpecial', 'tvShort', 'video')
+
+
+def imdb_id_to_int(_imdb_id):
+    # 'tt0111161' -> 111161
+    return int(_imdb_id[2:])
+
+
+def int_to_imdb_id(_number):
+    # ids below ten million are zero padded to 7 digits, newer ones use 8
+    return f'tt{_number:07d}'
+
+
+class ImdbIds:
+    # read only sequence over packed tt numbers, 'ttXXXXXXX' strings are built lazily
+
+    def __init__(self, _numbers):
+        self.numbers = _numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        # converting a block at a time avoids one numpy scalar per id
+        for _start in range(0, len(self.numbers), ITER_BLOCK_SIZE):
+            for _number in self.numbers[_start:_start + ITER_BLOCK_SIZE].tolist():
+                yield int_to_imdb_id(_number)
+
+    def __getitem__(self, _index):
+        if isinstance(_index, slice):
+            return ImdbIds(self.numbers[_index])
+        return int_to_imdb_id(int(self.numbers[_index]))
 
 
 def write_imdb_id(data):
-    with open(ID_DUMP_PATH, 'wb') as file:
-        pkl.dump(data, file)
+    _numbers = np.fromiter((imdb_id_to_int(_imdb_id) for _imdb_id in data), dtype=np.uint32)
+    np.save(ID_CACHE_PATH, _numbers)
+    # the title types no longer line up with the ids
+    if os.path.isfile(TITLE_TYPE_CACHE_PATH):
+        os.remove(TITLE_TYPE_CACHE_PATH)
 
 
-def get_imdb_ids_dump():
-    _imdb_data_path = os.path.join(CURRENT_DIR_PATH, 'data.tsv')
-    _imdb_id_list = []
-    if os.path.isfile(ID_DUMP_PATH):
-        print('imdb_ids_dump found loading..')
-        with open(ID_DUMP_PATH, 'rb') as file:
-            return pkl.load(file)
-    else:
-        print('imdb_ids_dump not found, please wait.')
-        with open(_imdb_data_path, 'r', encoding='utf') as file:
-            _lines = file.readlines()
+def _read_imdb_data(_imdb_data_path):
+    # only the tconst and titleType columns are parsed, chunk by chunk, straight into numpy
+    _id_chunks = []
+    _type_chunks = []
+    _type_codes = {_title_type: _code for _code, _title_type in enumerate(TITLE_TYPES)}
+    _reader = pd.read_csv(_imdb_data_path, sep='\t', usecols=['tconst', 'titleType'], dtype=str,
+                          quoting=3, chunksize=CHUNK_SIZE)
+    for _chunk in _reader:
+        _id_chunks.append(_chunk['tconst'].str.slice(2).astype(np.uint32).to_numpy())
+        _type_chunks.append(_chunk['titleType'].map(_type_codes).fillna(UNKNOWN_TITLE_TYPE)
+                            .astype(np.uint8).to_numpy())
+    if not _id_chunks:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint8)
+    return np.concatenate(_id_chunks), np.concatenate(_type_chunks)
+
+
+def _filter_title_types(_numbers, _title_types):
+    if _title_types is None:
+        return _numbers
+    if not os.path.isfile(TITLE_TYPE_CACHE_PATH):
+        print('no title types cached, the id list is not filtered')
+        return _numbers
+    _types = np.load(TITLE_TYPE_CACHE_PATH, mmap_mode='r')
+    _codes = [TITLE_TYPES.index(_title_type) for _title_type in _title_types]
+    _filtered = _numbers[np.isin(_types, _codes)]
+    print(f'{len(_numbers) - len(_filtered)} of {len(_numbers)} ids pruned, '
+          f'keeping title types: {", ".join(_title_types)}')
+    return _filtered
 
-        for _line in _lines:
-            _imdb_id = re.search('([^\s]+)', _line)
-            _imdb_id_list.append(_imdb_id.group(0))
 
-        write_imdb_id(_imdb_id_list)
-        print('imdb_ids_dump was created successfully.')
-    return _imdb_id_list
+def _cache_is_fresh(_imdb_data_path):
+    if not os.path.isfile(ID_CACHE_PATH):
+        return False
+    if not os.path.isfile(_imdb_data_path):
+        return True
+    # rebuild caches written before the title types were stored
+    if not os.path.isfile(TITLE_TYPE_CACHE_PATH):
+        return False
+    return os.path.getmtime(ID_CACHE_PATH) >= os.path.getmtime(_imdb_data_path)
+
+
+def get_imdb_ids_dump(_imdb_data_path=IMDB_DATA_PATH, title_types=DEFAULT_TITLE_TYPES):
+    # title_types=None keeps every id
+    if _cache_is_fresh(_imdb_data_path):
+        print('imdb_ids cache found loading..')
+    elif not os.path.isfile(_imdb_data_path) and os.path.isfile(ID_DUMP_PATH):
+        print('converting imdb_ids_dump to the compact cache, please wait.')
+        with open(ID_DUMP_PATH, 'rb') as file:
+            write_imdb_id(pkl.load(file))
+    else:
+        print('imdb_ids cache not found, please wait.')
+        _numbers, _types = _read_imdb_data(_imdb_data_path)
+        np.save(TITLE_TYPE_CACHE_PATH, _types)
+        np.save(ID_CACHE_PATH, _numbers)
+        print('imdb_ids cache was created successfully.')
+    _numbers = np.load(ID_CACHE_PATH, mmap_mode='r')
+    return ImdbIds(_filter_title_types(_numbers, title_types))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,21 @@
 from abc import ABC
 from dataclasses import dataclass
+from operator import attrgetter
+from typing import ClassVar
 
 
-@dataclass
+def _insert_statement(_table_name, _columns, _verb='INSERT'):
+    return f"""{_verb} INTO {_table_name} ({', '.join(_columns)}) VALUES ({', '.join('?' * len(_columns))})"""
+
+
+def _upsert_statement(_table_name, _columns):
+    # an existing row keeps its rowid and its refresh bookkeeping, only the data columns and scraped_at change
+    _updates = ', '.join(f'{_column} = excluded.{_column}' for _column in _columns if _column != 'imdb_id')
+    return (f"{_insert_statement(_table_name, (*_columns, 'scraped_at'))} ON CONFLICT(imdb_id) DO UPDATE SET "
+            f"{_updates}, scraped_at = COALESCE(excluded.scraped_at, scraped_at)")
+
+
+@dataclass(slots=True)
 class Imdb(ABC):
     imdb_id: str
     title: str
@@ -18,35 +31,48 @@ class Imdb(ABC):
     countries: str
     actors: str
 
-    def insertion_command(self) -> str:
-        ...
+    TABLE_NAME: ClassVar[str]
+    # column order of the table, insertion_values() returns the values in the same order
+    COLUMNS: ClassVar[tuple]
+    INSERT_STATEMENT: ClassVar[str]
+    UPSERT_STATEMENT: ClassVar[str]
+    _VALUES: ClassVar[attrgetter]
+
+    def insertion_values(self) -> tuple:
+        return self._VALUES(self)
+
+    def insertion_parameters(self, upsert=False, scraped_at=None) -> tuple:
+        # scraped_at: when the page was fetched, only stored by the upsert. None means now
+        if upsert:
+            return self.UPSERT_STATEMENT, (*self.insertion_values(), scraped_at)
+        return self.INSERT_STATEMENT, self.insertion_values()
 
 
-@dataclass
+@dataclass(slots=True)
 class ImdbSerie(Imdb):
     creator: str
     runtime: str
     years: str
     seasons: str
 
-    def insertion_command(self):
-        _insert_command = f"""INSERT INTO serie_details VALUES 
-                            ("{self.imdb_id}", "{self.title}", "{self.original_title}", "{self.score}", 
-                            "{self.voters}", "{self.plot}", "{self.poster}", "{self.rated}", 
-                            "{self.genre}", "{self.media_type}", "{self.release_date}", "{self.countries}", "{self.actors}", 
-                            "{self.creator}", "{self.runtime}", "{self.years}", "{self.seasons}")"""
-        return _insert_command
+    TABLE_NAME: ClassVar[str] = 'serie_details'
+    COLUMNS: ClassVar[tuple] = ('imdb_id', 'title', 'original_title', 'score', 'voters', 'plot', 'poster', 'rated',
+                                'genre', 'media_type', 'release_date', 'countries', 'actors', 'creator', 'runtime',
+                                'years', 'seasons')
+    # one prepared statement per table, shared by every row
+    INSERT_STATEMENT: ClassVar[str] = _insert_statement(TABLE_NAME, COLUMNS)
+    UPSERT_STATEMENT: ClassVar[str] = _upsert_statement(TABLE_NAME, COLUMNS)
+    _VALUES: ClassVar[attrgetter] = attrgetter(*COLUMNS)
 
 
-@dataclass
+@dataclass(slots=True)
 class ImdbMovie(Imdb):
     director: str
     runtime: str
 
-    def insertion_command(self):
-        _insert_command = f"""INSERT INTO movie_details VALUES 
-                            ("{self.imdb_id}", "{self.title}", "{self.original_title}", "{self.score}", 
-                            "{self.voters}", "{self.plot}", "{self.poster}", "{self.rated}", 
-                            "{self.genre}", "{self.media_type}", "{self.release_date}", "{self.countries}", 
-                            "{self.actors}", "{self.director}", "{self.runtime}")"""
-        return _insert_command
+    TABLE_NAME: ClassVar[str] = 'movie_details'
+    COLUMNS: ClassVar[tuple] = ('imdb_id', 'title', 'original_title', 'score', 'voters', 'plot', 'poster', 'rated',
+                                'genre', 'media_type', 'release_date', 'countries', 'actors', 'director', 'runtime')
+    INSERT_STATEMENT: ClassVar[str] = _insert_statement(TABLE_NAME, COLUMNS)
+    UPSERT_STATEMENT: ClassVar[str] = _upsert_statement(TABLE_NAME, COLUMNS)
+    _VALUES: ClassVar[attrgetter] = attrgetter(*COLUMNS)
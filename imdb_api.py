@@ -1,88 +1,307 @@
-import os
 import urllib.parse
 import uvicorn
-from fastapi import FastAPI, Request, Form, Query
+from fastapi import FastAPI, Request, Form, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from databases import Database
 from datetime import datetime
-from imdb_scrapper import single_scrape
-from typing import Optional
+from imdb_database import (LEADERBOARD_FILTER, MEDIA_TABLES, MEDIA_VIEW, SEARCH_TABLES, UNRATED_VOTERS,
+                           media_projection, search_query)
+from imdb_http import configure_session
+from imdb_on_demand import OnDemandScraper, ScrapeQueueFull
+from imdb_response_cache import ResponseCache, serialise_row, serialise_rows
+from imdb_scrapper import DATABASE_LOCATION, scrape_and_store, set_up_database
+from pydantic import BaseModel
+from typing import List, Literal, Optional
 
 app = FastAPI()
-CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
-DATABASE_NAME = "imdb.db"
 MOVIES_TABLE = "movie_details"
 SERIES_TABLE = "serie_details"
-DATABASE_LOCATION = os.path.join(CURRENT_DIR_PATH, DATABASE_NAME)
 REDDIT_GOALS_DB = Database(f"sqlite:///{DATABASE_LOCATION}")
+# the trigram index can't match anything shorter
+MIN_SEARCH_LENGTH = 3
+RESPONSE_CACHE = ResponseCache(DATABASE_LOCATION)
+ON_DEMAND_SCRAPER = OnDemandScraper(scrape_and_store)
+MAX_LOOKUP_IDS = 1000
+LOOKUP_CHUNK_SIZE = 500
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+ResponseFormat = Literal["json", "ndjson"]
 
 
 @app.on_event("startup")
 async def database_connect():
+    # creates and migrates the schema once, on-demand scrapes skip it
+    set_up_database()
     await REDDIT_GOALS_DB.connect()
+    RESPONSE_CACHE.open()
+    # one pooled connection per scraper thread
+    configure_session(pool_size=ON_DEMAND_SCRAPER.max_concurrent)
 
 
 @app.on_event("shutdown")
 async def database_disconnect():
+    ON_DEMAND_SCRAPER.close()
+    RESPONSE_CACHE.close()
     await REDDIT_GOALS_DB.disconnect()
 
 
-@app.get("/")
-async def fetch_data():
-    query = f"SELECT * FROM {MOVIES_TABLE} ORDER BY voters DESC, score DESC LIMIT 200"
-    results = await REDDIT_GOALS_DB.fetch_all(query=query)
+def json_response(_body, _cache_status):
+    return Response(content=_body, media_type="application/json", headers={"X-Cache": _cache_status})
 
-    return results
 
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return RESPONSE_CACHE.stats()
 
-@app.get("/movies")
-async def fetch_movies():
-    query = f"SELECT * FROM {MOVIES_TABLE} WHERE voters > 10000 and countries NOT LIKE 'IN%' ORDER BY score DESC, voters DESC LIMIT 200"
-    movies = await REDDIT_GOALS_DB.fetch_all(query=query)
 
-    return movies
+@app.get("/api/scraper/stats")
+async def scraper_stats():
+    return ON_DEMAND_SCRAPER.stats()
+
+
+class ListingOrder:
+    # a listing is sorted DESC on these columns, imdb_id last so that every row has a unique position.
+    # the cursor of a row is its values joined by commas, "8.5,120000,tt0111161" for score, voters, imdb_id.
+    # a column that can be NULL is sorted on a generated column standing in for it, sort_columns maps
+    # the column to (generated column, value it holds for NULL)
+    COLUMN_TYPES = {"score": float, "voters": int, "imdb_id": str}
+
+    def __init__(self, *_columns, sort_columns=None):
+        self.columns = _columns
+        self.sort_columns = sort_columns or {}
+
+    def _sort_column(self, _column):
+        return self.sort_columns[_column][0] if _column in self.sort_columns else _column
+
+    @property
+    def order_by(self):
+        return ", ".join(f"{self._sort_column(_column)} DESC" for _column in self.columns)
+
+    def _sort_value(self, _row, _column):
+        _value = _row[_column]
+        if _value is None and _column in self.sort_columns:
+            return self.sort_columns[_column][1]
+        return _value
+
+    def cursor_of(self, _row):
+        return ",".join(str(self._sort_value(_row, _column)) for _column in self.columns)
+
+    def parse_cursor(self, _cursor):
+        _values = _cursor.split(",")
+        if len(_values) != len(self.columns):
+            raise ValueError(f"a cursor has {len(self.columns)} values: {', '.join(self.columns)}")
+        return {_column: self.COLUMN_TYPES[_column](_value) for _column, _value in zip(self.columns, _values)}
+
+    def after(self, _cursor, _alias=None):
+        # keyset condition, the index seeks straight to the row after the cursor
+        _values = self.parse_cursor(_cursor)
+        _prefix = f"{_alias}." if _alias else ""
+        _sort_columns = ", ".join(f"{_prefix}{self._sort_column(_column)}" for _column in self.columns)
+        return f"({_sort_columns}) < ({', '.join(f':{_column}' for _column in self.columns)})", _values
+
+
+# unrated titles have no voters, they come last
+POPULAR_ORDER = ListingOrder("voters", "score", "imdb_id",
+                             sort_columns={"voters": ("sorted_voters", UNRATED_VOTERS)})
+# the leaderboard filter leaves out titles without voters
+LEADERBOARD_ORDER = ListingOrder("score", "voters", "imdb_id")
+# search results of both tables, unrated titles last among those with the same score
+SEARCH_ORDER = ListingOrder("score", "voters", "imdb_id", sort_columns={"voters": ("sorted_voters", UNRATED_VOTERS)})
+
+
+async def stream_ndjson(_query, _values=None):
+    # rows are written as they come off the cursor, a full catalogue pull runs in constant memory
+    async for row in REDDIT_GOALS_DB.iterate(query=_query, values=_values):
+        yield serialise_row(row) + b"\n"
+
+
+def ndjson_response(_lines):
+    return StreamingResponse(_lines, media_type=NDJSON_MEDIA_TYPE)
+
+
+async def fetch_listing(_request, _table, _filter, _order, _cursor, _limit, _format):
+    conditions = [_filter] if _filter else []
+    values = {}
+    if _cursor:
+        try:
+            condition, values = _order.after(_cursor)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"detail": f"invalid cursor: {e}"})
+        conditions.append(condition)
+    # the media view columns, the refresh bookkeeping stays out of the responses
+    query = f"SELECT {media_projection(_table)} FROM {_table}"
+    if conditions:
+        query += f" WHERE {' AND '.join(conditions)}"
+    query += f" ORDER BY {_order.order_by}"
+    return await paged_response(_request, query, values, _order, _cursor, _limit, _format)
+
+
+async def paged_response(_request, _query, _values, _order, _cursor, _limit, _format):
+    # _query is sorted in _order and starts after _cursor, json gets one page of it and ndjson every row
+    if _format == "ndjson":
+        # no limit streams the whole listing from the cursor on
+        if _limit is not None:
+            _query += f" LIMIT {_limit}"
+        return ndjson_response(stream_ndjson(_query, _values))
+    limit = DEFAULT_PAGE_SIZE if _limit is None else _limit
+    if limit > MAX_PAGE_SIZE:
+        return JSONResponse(status_code=400, content={"detail": f"limit is at most {MAX_PAGE_SIZE}, use format=ndjson"})
+    _query += f" LIMIT {limit}"
+    # the rows are serialised once and the bytes served until the ttl runs out or a new row is committed
+    cache_key = f"{_request.url.path}?{_request.url.include_query_params(cursor=_cursor or '', limit=limit).query}"
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        body, next_cursor = cached
+        cache_status = "HIT"
+    else:
+        rows = await REDDIT_GOALS_DB.fetch_all(query=_query, values=_values)
+        body = serialise_rows(rows)
+        next_cursor = _order.cursor_of(rows[-1]) if len(rows) == limit else None
+        RESPONSE_CACHE.put(cache_key, (body, next_cursor))
+        cache_status = "MISS"
+    response = json_response(body, cache_status)
+    if next_cursor is not None:
+        # the body stays a plain list, the next page is announced in the headers
+        response.headers["X-Next-Cursor"] = next_cursor
+        next_url = _request.url.include_query_params(cursor=next_cursor, limit=limit)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+@app.get("/")
+async def fetch_data(request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                     format: ResponseFormat = "json"):
+    return await fetch_listing(request, MOVIES_TABLE, None, POPULAR_ORDER, cursor, limit, format)
+
+
+@app.get("/movies")
+async def fetch_movies(request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                       format: ResponseFormat = "json"):
+    return await fetch_listing(request, MOVIES_TABLE, LEADERBOARD_FILTER, LEADERBOARD_ORDER, cursor, limit, format)
 
 
 @app.get("/series")
-async def fetch_movies():
-    query = f"SELECT * FROM {SERIES_TABLE} WHERE voters > 10000 and countries NOT LIKE 'IN%' ORDER BY score DESC, voters DESC LIMIT 200"
-    series = await REDDIT_GOALS_DB.fetch_all(query=query)
+async def fetch_movies(request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                       format: ResponseFormat = "json"):
+    return await fetch_listing(request, SERIES_TABLE, LEADERBOARD_FILTER, LEADERBOARD_ORDER, cursor, limit, format)
 
-    return series
+
+async def find_media(_imdb_id):
+    # one primary key lookup in each table, through the media view
+    query = f"SELECT * FROM {MEDIA_VIEW} WHERE imdb_id = :imdb_id"
+    return await REDDIT_GOALS_DB.fetch_all(query=query, values={"imdb_id": _imdb_id})
+
+
+def scrape_pending(_imdb_id):
+    # the client polls the same url until the scrape is done
+    location = f"/api/{_imdb_id}"
+    return JSONResponse(status_code=202, content={"imdb_id": _imdb_id, "status": "pending", "location": location},
+                        headers={"Location": location, "Retry-After": "5"})
 
 
 @app.get("/api/{imdb_id}")
-async def fetch_movies(imdb_id: str):
-    query = f'SELECT * FROM {MOVIES_TABLE} WHERE imdb_id like "{imdb_id}"'
-    search_result = await REDDIT_GOALS_DB.fetch_all(query=query)
-    if not search_result:
-        query = f'SELECT * FROM {SERIES_TABLE} WHERE imdb_id like "{imdb_id}"'
-        search_result = await REDDIT_GOALS_DB.fetch_all(query=query)
-    if not search_result:
-        single_scrape(imdb_id)
-        query = f'SELECT * FROM {MOVIES_TABLE} WHERE imdb_id like "{imdb_id}"'
-        search_result = await REDDIT_GOALS_DB.fetch_all(query=query)
-        if not search_result:
-            query = f'SELECT * FROM {SERIES_TABLE} WHERE imdb_id like "{imdb_id}"'
-            search_result = await REDDIT_GOALS_DB.fetch_all(query=query)
-    return search_result
+async def fetch_movies(imdb_id: str, wait: bool = True):
+    imdb_id = imdb_id.strip().lower()
+    cache_key = f"/api/{imdb_id}"
+    body = RESPONSE_CACHE.get(cache_key)
+    if body is not None:
+        return json_response(body, "HIT")
+    search_result = await find_media(imdb_id)
+    if not search_result and ON_DEMAND_SCRAPER.is_valid(imdb_id):
+        # the scrape runs in the scraper pool, other requests are served meanwhile
+        try:
+            if not wait:
+                ON_DEMAND_SCRAPER.submit(imdb_id)
+                return scrape_pending(imdb_id)
+            if not await ON_DEMAND_SCRAPER.scrape_and_wait(imdb_id):
+                return scrape_pending(imdb_id)
+        except ScrapeQueueFull:
+            return JSONResponse(status_code=503, content={"imdb_id": imdb_id, "status": "busy"},
+                                headers={"Retry-After": "30"})
+        search_result = await find_media(imdb_id)
+    body = serialise_rows(search_result)
+    # ids that could not be scraped are looked up again next time
+    if search_result:
+        RESPONSE_CACHE.put(cache_key, body)
+    return json_response(body, "MISS")
+
+
+class LookupRequest(BaseModel):
+    imdb_ids: List[str]
+    # queue the ids found in neither table for an on demand scrape
+    scrape_missing: bool = False
+
+
+@app.post("/api/lookup")
+async def lookup_media(lookup: LookupRequest):
+    # duplicates are looked up once, results come back in the order the ids were asked
+    imdb_ids = list(dict.fromkeys(_imdb_id.strip().lower() for _imdb_id in lookup.imdb_ids))
+    if len(imdb_ids) > MAX_LOOKUP_IDS:
+        return JSONResponse(status_code=413, content={"detail": f"at most {MAX_LOOKUP_IDS} ids per lookup"})
+    found = {}
+    # primary key lookups in both tables through the media view, a chunk stays well below sqlite's bound parameter limit
+    for start in range(0, len(imdb_ids), LOOKUP_CHUNK_SIZE):
+        chunk = imdb_ids[start:start + LOOKUP_CHUNK_SIZE]
+        values = {f"id{index}": _imdb_id for index, _imdb_id in enumerate(chunk)}
+        query = f"SELECT * FROM {MEDIA_VIEW} WHERE imdb_id IN ({', '.join(f':{name}' for name in values)})"
+        for row in await REDDIT_GOALS_DB.fetch_all(query=query, values=values):
+            found[row["imdb_id"]] = dict(row._mapping)
+    missing = [_imdb_id for _imdb_id in imdb_ids if _imdb_id not in found]
+    queued = []
+    if lookup.scrape_missing:
+        for _imdb_id in missing:
+            if not ON_DEMAND_SCRAPER.is_valid(_imdb_id):
+                continue
+            try:
+                ON_DEMAND_SCRAPER.submit(_imdb_id)
+            except ScrapeQueueFull:
+                break
+            queued.append(_imdb_id)
+    return {
+        "results": [found[_imdb_id] for _imdb_id in imdb_ids if _imdb_id in found],
+        "missing": missing,
+        "queued": queued,
+    }
+
+
+def search_query_sql(_title, _year=None, _cursor=None):
+    # one query for both tables, sqlite merges the two sorted matches (MERGE UNION ALL).
+    # raises ValueError for an invalid _cursor
+    selects = []
+    after, values = SEARCH_ORDER.after(_cursor, "m") if _cursor else (None, {})
+    for table in MEDIA_TABLES:
+        search_table = SEARCH_TABLES[table]
+        if len(_title) >= MIN_SEARCH_LENGTH:
+            # trigram full text match
+            select = (f"SELECT {media_projection(table, 'm')} FROM {search_table} s JOIN {table} m ON m.rowid = s.rowid "
+                      f"WHERE {search_table} MATCH :match")
+        else:
+            # titles shorter than one trigram fall back to LIKE
+            select = f"SELECT {media_projection(table, 'm')} FROM {table} m WHERE m.title LIKE :like"
+        if _year is not None:
+            select += " AND m.release_year = :year"
+        if after:
+            select += f" AND {after}"
+        selects.append(select)
+    if len(_title) >= MIN_SEARCH_LENGTH:
+        values["match"] = search_query(_title)
+    else:
+        values["like"] = f"%{_title}%"
+    if _year is not None:
+        values["year"] = _year
+    # the ORDER BY of a UNION only takes result columns: voters DESC puts NULL last, the order of sorted_voters
+    return f"{' UNION ALL '.join(selects)} ORDER BY score DESC, voters DESC, imdb_id DESC", values
 
 
 @app.get("/api/search/{title}")
-async def fetch_movies(title: str, year: Optional[str] = None):
-    if not year:
-        query = f'SELECT * FROM {MOVIES_TABLE} WHERE title like "%{title}%" ORDER BY score DESC, voters DESC LIMIT 200'
-        search_movies = await REDDIT_GOALS_DB.fetch_all(query=query)
-        query = f'SELECT * FROM {SERIES_TABLE} WHERE title like "%{title}%" ORDER BY score DESC, voters DESC LIMIT 200'
-        search_series = await REDDIT_GOALS_DB.fetch_all(query=query)
-        return search_movies + search_series
-
-    query = f'SELECT * FROM {MOVIES_TABLE} WHERE title like "%{title}%" and strftime("%Y", release_date) like "{year}" ORDER BY score DESC, voters DESC LIMIT 200'
-    print(query)
-    search_movies = await REDDIT_GOALS_DB.fetch_all(query=query)
-
-    query = f'SELECT * FROM {SERIES_TABLE} WHERE title like "%{title}%" and strftime("%Y", release_date) like "{year}" ORDER BY score DESC, voters DESC LIMIT 200'
-    search_series = await REDDIT_GOALS_DB.fetch_all(query=query)
-    return search_movies + search_series
+async def fetch_movies(request: Request, title: str, year: Optional[int] = None, cursor: Optional[str] = None,
+                       limit: Optional[int] = Query(None, ge=1), format: ResponseFormat = "json"):
+    try:
+        query, values = search_query_sql(title, year, cursor)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": f"invalid cursor: {e}"})
+    return await paged_response(request, query, values, SEARCH_ORDER, cursor, limit, format)
 
 
 if __name__ == "__main__":
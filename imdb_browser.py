@@ -0,0 +1,143 @@
+# Pool of warm headless chrome instances for the selenium fallback
+import atexit
+import logging
+import queue
+import threading
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support.ui import WebDriverWait
+
+
+################################################################################
+
+# chrome processes allowed at the same time
+DEFAULT_MAX_BROWSERS = 2
+# pages loaded by one chrome before it is replaced, keeps memory leaks in check
+DEFAULT_MAX_PAGES = 50
+# seconds to wait for document.readyState to become complete
+DEFAULT_PAGE_TIMEOUT = 15
+# seconds to wait for a free browser before giving up
+DEFAULT_ACQUIRE_TIMEOUT = 60
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+def _chrome_options():
+    chrome_options = Options()
+    chrome_options.add_argument('--headless')
+    chrome_options.add_argument("--incognito")
+    chrome_options.add_argument("--disable-crash-reporter")
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--disable-in-process-stack-traces")
+    chrome_options.add_argument("--disable-my_logger")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--log-level=3")
+    chrome_options.add_argument("--output=/dev/null")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--disable-features=NetworkService")
+    chrome_options.add_argument("--window-size=1920x1080")
+    chrome_options.add_argument("--disable-features=VizDisplayCompositor")
+    return chrome_options
+
+
+class PooledBrowser:
+    def __init__(self, _driver_path):
+        self.driver = webdriver.Chrome(service=Service(_driver_path), options=_chrome_options())
+        self.driver.implicitly_wait(0.1)
+        self.pages = 0
+
+    def is_healthy(self):
+        try:
+            return self.driver.execute_script('return 1') == 1
+        except WebDriverException:
+            return False
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except WebDriverException as e:
+            my_logger.warn(f'browser did not quit cleanly: {e!r}')
+
+
+class BrowserPool:
+    def __init__(self, _driver_path, max_browsers=DEFAULT_MAX_BROWSERS, max_pages=DEFAULT_MAX_PAGES,
+                 page_timeout=DEFAULT_PAGE_TIMEOUT, acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        self.driver_path = _driver_path
+        self.max_browsers = max_browsers
+        self.max_pages = max_pages
+        self.page_timeout = page_timeout
+        self.acquire_timeout = acquire_timeout
+        self.browsers_started = 0
+        self.browsers_recycled = 0
+        self._idle = queue.LifoQueue()
+        # one slot per browser that may exist, idle or in use
+        self._slots = threading.BoundedSemaphore(max_browsers)
+        self._closed = False
+        atexit.register(self.close)
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError('no browser available in the pool')
+        try:
+            _browser = self._idle.get_nowait()
+        except queue.Empty:
+            _browser = None
+        if _browser is not None and not _browser.is_healthy():
+            my_logger.warn('unhealthy browser replaced')
+            _browser.quit()
+            _browser = None
+        if _browser is None:
+            try:
+                _browser = PooledBrowser(self.driver_path)
+            except Exception:
+                self._slots.release()
+                raise
+            self.browsers_started += 1
+        return _browser
+
+    def _release(self, _browser, _broken=False):
+        if _broken or self._closed or _browser.pages >= self.max_pages:
+            _browser.quit()
+            self.browsers_recycled += 1
+        else:
+            self._idle.put(_browser)
+        self._slots.release()
+
+    def get_page_source(self, _link):
+        _browser = self._acquire()
+        try:
+            _browser.driver.get(_link)
+            try:
+                # wait for the page to be ready instead of sleeping a fixed time
+                WebDriverWait(_browser.driver, self.page_timeout).until(
+                    lambda _driver: _driver.execute_script('return document.readyState') == 'complete')
+            except TimeoutException:
+                my_logger.warn(f'{_link}, page not ready after {self.page_timeout} s')
+            _html = _browser.driver.page_source
+        except WebDriverException:
+            self._release(_browser, _broken=True)
+            raise
+        _browser.pages += 1
+        self._release(_browser)
+        return _html
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().quit()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        return {
+            'idle': self._idle.qsize(),
+            'started': self.browsers_started,
+            'recycled': self.browsers_recycled,
+        }
@@ -0,0 +1,361 @@
+# Concurrent crawl engine, fetch / parse / persist run as separate pipeline stages
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import aiohttp
+from data.crawl_journal import CrawlJournal
+from data.html_cache import HtmlCache
+from data.imdb_id import DEFAULT_TITLE_TYPES, get_imdb_ids_dump
+from imdb_database import DatabaseWriter, KnownIds
+from imdb_extract import FallbackStats, parse_html_fast
+from imdb_http import HEADERS
+from imdb_rate_limiter import AdaptiveRateLimiter
+from imdb_scrapper import DATABASE_LOCATION, IMDB_BASE_PATH, MAX_FETCH_ATTEMPTS, StrategyProfiler, set_up_database
+
+
+################################################################################
+
+# number of pages being downloaded at the same time
+DEFAULT_CONCURRENCY = 32
+# number of open connections allowed to a single host (www.imdb.com)
+DEFAULT_PER_HOST_LIMIT = 16
+# seconds between two throughput reports
+REPORT_INTERVAL = 30
+# number of worker processes building the soup and running the extractors
+DEFAULT_PARSE_WORKERS = os.cpu_count() or 1
+FETCH_TIMEOUT = 30
+# requests/sec the adaptive limiter starts from before it probes upwards
+DEFAULT_INITIAL_RATE = 8.0
+# times a broken parse pool is replaced before the run is aborted
+MAX_POOL_RESTARTS = 3
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+class CrawlStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.fetched = 0
+        self.parsed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.movies_added = 0
+        self.series_added = 0
+        self.fallbacks = FallbackStats()
+        # merged from the samples the parse workers send back
+        self.countries = StrategyProfiler()
+
+    def pages_per_second(self):
+        _elapsed = time.monotonic() - self.started
+        if _elapsed <= 0:
+            return 0.0
+        return self.fetched / _elapsed
+
+    def report(self):
+        return (f'{self.pages_per_second():.2f} pages/sec - fetched: {self.fetched}, parsed: {self.parsed}, '
+                f'skipped: {self.skipped}, failed: {self.failed}, '
+                f'movies added: {self.movies_added}, series added: {self.series_added}, '
+                f'{self.fallbacks.report()}, countries: {self.countries.report()}')
+
+
+class ParsePool:
+    # process pool of the parse stage. a worker that dies (out of memory, a crash in lxml) breaks the whole
+    # ProcessPoolExecutor, every later page would fail with it. the pool is replaced and the page parsed again,
+    # after max_restarts the run is aborted with BrokenProcessPool and the pages in flight stay pending
+
+    def __init__(self, _workers, max_restarts=MAX_POOL_RESTARTS):
+        self.workers = _workers
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self._executor = ProcessPoolExecutor(max_workers=_workers)
+
+    async def run(self, _function, *_args):
+        _loop = asyncio.get_running_loop()
+        while True:
+            _executor = self._executor
+            try:
+                return await _loop.run_in_executor(_executor, _function, *_args)
+            except BrokenProcessPool:
+                self._restart(_executor)
+
+    def _restart(self, _broken):
+        if self._executor is not _broken:
+            # another parser already replaced it
+            return
+        if self.restarts >= self.max_restarts:
+            raise BrokenProcessPool(f'parse pool broke {self.restarts + 1} times, aborting')
+        self.restarts += 1
+        my_logger.warn(f'parse pool broken, starting a new one ({self.restarts}/{self.max_restarts})')
+        _broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+async def _feed_stage(_imdb_ids, _known_ids, _journal, _frontier_queue, _stats, _workers):
+    for imdb_id in _journal.pending(_imdb_ids):
+        if imdb_id in _known_ids:
+            _journal.skipped(imdb_id)
+            _stats.skipped += 1
+            continue
+        await _frontier_queue.put(imdb_id)
+    # one stop signal per fetch worker
+    for _ in range(_workers):
+        await _frontier_queue.put(None)
+
+
+async def _fetch_page(_session, _limiter, _link):
+    # returns the page html, None for a 404 and False when the page could not be fetched
+    for _attempt in range(MAX_FETCH_ATTEMPTS):
+        await _limiter.acquire_async()
+        _start = time.perf_counter()
+        try:
+            async with _session.get(_link) as _response:
+                if _response.status == 404:
+                    return None
+                _html = await _response.text()
+        except aiohttp.ClientPayloadError:
+            _limiter.on_throttle('truncated response')
+            continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            my_logger.warn(f'{_link}, {e!r}')
+            return False
+        if not _limiter.record(_response.status, time.perf_counter() - _start):
+            continue
+        # imdb serves pages without the ld+json when it is throttling us
+        if 'application/ld+json' not in _html:
+            _limiter.on_throttle('empty ld+json')
+            continue
+        return _html
+    my_logger.warn(f'{_link}, still throttled after {MAX_FETCH_ATTEMPTS} attempts')
+    return False
+
+
+async def _fetch_stage(_session, _limiter, _journal, _html_cache, _frontier_queue, _parse_queue, _stats):
+    while True:
+        imdb_id = await _frontier_queue.get()
+        if imdb_id is None:
+            return
+        _link = f'{IMDB_BASE_PATH}{imdb_id}'
+        _html = await _fetch_page(_session, _limiter, _link)
+        if _html is None:
+            my_logger.warn(f'{_link}, 404 page not found')
+            _journal.failed(imdb_id)
+            _stats.failed += 1
+            continue
+        if _html is False:
+            _stats.failed += 1
+            continue
+        _stats.fetched += 1
+        if _html_cache is not None:
+            # raw pages are kept so a broken extractor can be fixed with replay() instead of a recrawl
+            await asyncio.to_thread(_html_cache.store, imdb_id, _html)
+        # fetched now, the database stamps scraped_at itself
+        await _parse_queue.put((imdb_id, _html, None))
+
+
+async def _replay_feed_stage(_html_cache, _parse_queue, _stats, _parsers):
+    _pages = _html_cache.iter_latest()
+    while True:
+        # reading and decompressing a page is blocking, it runs off the event loop
+        _page = await asyncio.to_thread(next, _pages, None)
+        if _page is None:
+            break
+        _stats.fetched += 1
+        await _parse_queue.put(_page)
+    for _ in range(_parsers):
+        await _parse_queue.put(None)
+
+
+async def _parse_stage(_pool, _journal, _parse_queue, _persist_queue, _stats):
+    while True:
+        _page = await _parse_queue.get()
+        if _page is None:
+            return
+        imdb_id, _html, _fetched_at = _page
+        try:
+            # parsing is cpu bound, it runs in the process pool so the fetchers never wait on it
+            details, _fallbacks, _samples = await _pool.run(parse_html_fast, imdb_id, _html)
+            _stats.fallbacks.record(_fallbacks)
+            _stats.countries.merge(_samples)
+        except BrokenProcessPool:
+            # not the page's fault, it is left out of the journal and crawled again by the next run
+            raise
+        except Exception as e:
+            my_logger.warn(f'{imdb_id}, parse failed {e!r}')
+            details = False
+        if not details:
+            if _journal is not None:
+                _journal.failed(imdb_id)
+            _stats.failed += 1
+            continue
+        _stats.parsed += 1
+        await _persist_queue.put((details, _fetched_at))
+
+
+async def _persist_stage(_writer, _persist_queue, _stats, _upsert=False):
+    while True:
+        _item = await _persist_queue.get()
+        if _item is None:
+            return
+        details, _fetched_at = _item
+        # the writer batches rows on its own thread, failed rows are logged there
+        _writer.add(details, _upsert, _fetched_at)
+        match details.media_type:
+            case 'TV Series':
+                _stats.series_added += 1
+            case 'Movie':
+                _stats.movies_added += 1
+        my_logger.info(f'{details.title} Added to database')
+
+
+async def _report_stage(_stats, _limiter, _writer, _interval):
+    while True:
+        await asyncio.sleep(_interval)
+        if _limiter is None:
+            my_logger.info(f'{_stats.report()} - {_writer.report()}')
+        else:
+            my_logger.info(f'{_stats.report()} - {_limiter.report()} - {_writer.report()}')
+
+
+async def _wait_for_stage(_stage_tasks, _parsers):
+    # waits for the tasks of a stage, or raises the error of the first parser that stops before them
+    _stage_tasks = set(_stage_tasks)
+    _pending = _stage_tasks | set(_parsers)
+    while _stage_tasks & _pending:
+        _done, _pending = await asyncio.wait(_pending, return_when=asyncio.FIRST_COMPLETED)
+        for _task in _done:
+            if _task.exception() is not None:
+                raise _task.exception()
+
+
+async def crawl(imdb_ids, concurrency=DEFAULT_CONCURRENCY, per_host_limit=DEFAULT_PER_HOST_LIMIT,
+                parse_workers=DEFAULT_PARSE_WORKERS, initial_rate=DEFAULT_INITIAL_RATE,
+                html_cache=None, report_interval=REPORT_INTERVAL, retry_failed=False):
+    set_up_database()
+    _stats = CrawlStats()
+    _limiter = AdaptiveRateLimiter(initial_rate=initial_rate)
+    _frontier_queue = asyncio.Queue(maxsize=concurrency * 2)
+    _parse_queue = asyncio.Queue(maxsize=concurrency * 2)
+    _persist_queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    # keep-alive pool sized to the crawl concurrency, same compression headers as imdb_http
+    _connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host_limit)
+    _timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    # two pages per worker in flight keeps every process busy while the next page is pickled over
+    _parser_count = parse_workers * 2
+    _known_ids = KnownIds(DATABASE_LOCATION)
+    _journal = CrawlJournal(retry_failed=retry_failed)
+    my_logger.info(f'crawl journal replayed: {_journal.counts}')
+
+    def _on_commit(_rows):
+        _known_ids.on_commit(_rows)
+        _journal.on_commit(_rows)
+
+    _writer = DatabaseWriter(DATABASE_LOCATION, on_commit=_on_commit)
+    _pool = ParsePool(parse_workers)
+    _tasks = []
+    try:
+        async with aiohttp.ClientSession(connector=_connector, timeout=_timeout, headers=HEADERS) as _session:
+            _reporter = asyncio.create_task(_report_stage(_stats, _limiter, _writer, report_interval))
+            _feeder = asyncio.create_task(
+                _feed_stage(imdb_ids, _known_ids, _journal, _frontier_queue, _stats, concurrency))
+            _fetchers = [asyncio.create_task(_fetch_stage(_session, _limiter, _journal, html_cache, _frontier_queue, _parse_queue, _stats))
+                         for _ in range(concurrency)]
+            _parsers = [asyncio.create_task(_parse_stage(_pool, _journal, _parse_queue, _persist_queue, _stats))
+                        for _ in range(_parser_count)]
+            _persister = asyncio.create_task(_persist_stage(_writer, _persist_queue, _stats))
+            _tasks = [_reporter, _feeder, *_fetchers, *_parsers, _persister]
+
+            # a parser aborting the run (BrokenProcessPool) is raised from here, not only once the feed is done
+            await _wait_for_stage([_feeder], _parsers)
+            await _wait_for_stage(_fetchers, _parsers)
+            for _ in range(_parser_count):
+                await _parse_queue.put(None)
+            await asyncio.gather(*_parsers)
+            await _persist_queue.put(None)
+            await _persister
+    finally:
+        for _task in _tasks:
+            _task.cancel()
+        _pool.shutdown()
+        # flush on shutdown, everything parsed ends up in the database
+        _writer.close()
+        _journal.close()
+    my_logger.info(f'crawl finished, {_stats.report()} - {_limiter.report()} - {_writer.report()}')
+    return _stats
+
+
+async def replay(html_cache, parse_workers=DEFAULT_PARSE_WORKERS, report_interval=REPORT_INTERVAL):
+    # re-runs the extractors over the cached pages, no network access.
+    # existing rows are updated in place: the data columns and scraped_at (when the page was fetched) change,
+    # change_seq only moves when a value differs, the refresh validators are kept
+    set_up_database()
+    _stats = CrawlStats()
+    _parse_queue = asyncio.Queue(maxsize=parse_workers * 4)
+    _persist_queue = asyncio.Queue(maxsize=parse_workers * 4)
+    _parser_count = parse_workers * 2
+    _writer = DatabaseWriter(DATABASE_LOCATION)
+    _pool = ParsePool(parse_workers)
+    _tasks = []
+    try:
+        _reporter = asyncio.create_task(_report_stage(_stats, None, _writer, report_interval))
+        _feeder = asyncio.create_task(_replay_feed_stage(html_cache, _parse_queue, _stats, _parser_count))
+        _parsers = [asyncio.create_task(_parse_stage(_pool, None, _parse_queue, _persist_queue, _stats))
+                    for _ in range(_parser_count)]
+        _persister = asyncio.create_task(_persist_stage(_writer, _persist_queue, _stats, True))
+        _tasks = [_reporter, _feeder, *_parsers, _persister]
+
+        await _wait_for_stage([_feeder], _parsers)
+        await asyncio.gather(*_parsers)
+        await _persist_queue.put(None)
+        await _persister
+    finally:
+        for _task in _tasks:
+            _task.cancel()
+        _pool.shutdown()
+        _writer.close()
+    my_logger.info(f'replay finished, {_stats.report()} - {_writer.report()}')
+    return _stats
+
+
+def main(imdb_ids, concurrency=DEFAULT_CONCURRENCY, per_host_limit=DEFAULT_PER_HOST_LIMIT,
+         parse_workers=DEFAULT_PARSE_WORKERS, initial_rate=DEFAULT_INITIAL_RATE, html_cache=None, retry_failed=False):
+    return asyncio.run(crawl(imdb_ids, concurrency, per_host_limit, parse_workers, initial_rate, html_cache,
+                             retry_failed=retry_failed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='concurrent imdb crawler')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='number of pages fetched at the same time')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST_LIMIT,
+                        help='number of open connections allowed per host')
+    parser.add_argument('--parse-workers', type=int, default=DEFAULT_PARSE_WORKERS,
+                        help='number of processes used to parse pages')
+    parser.add_argument('--initial-rate', type=float, default=DEFAULT_INITIAL_RATE,
+                        help='requests/sec to start from, the limiter adapts it to the responses')
+    parser.add_argument('--title-types', default=','.join(DEFAULT_TITLE_TYPES),
+                        help='comma separated titleType values to crawl, "all" disables the filter')
+    parser.add_argument('--cache-html', action='store_true',
+                        help='keep a compressed copy of every fetched page in data/html_cache')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='crawl the ids the journal recorded as failed again')
+    parser.add_argument('--replay', action='store_true',
+                        help='re-parse the cached pages instead of crawling, no network access')
+    args = parser.parse_args()
+    if args.replay:
+        asyncio.run(replay(HtmlCache(), args.parse_workers))
+    else:
+        _title_types = None if args.title_types == 'all' else tuple(args.title_types.split(','))
+        main(get_imdb_ids_dump(title_types=_title_types), args.concurrency, args.per_host, args.parse_workers,
+             args.initial_rate, HtmlCache() if args.cache_html else None, args.retry_failed)
@@ -0,0 +1,464 @@
+# Long lived sqlite writer, inserts are grouped into one transaction per batch
+import atexit
+import bisect
+import itertools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+
+from data.imdb_id import imdb_id_to_int
+from dataclass.imdb import ImdbMovie, ImdbSerie
+
+
+################################################################################
+
+# rows written in a single transaction
+DEFAULT_BATCH_SIZE = 500
+# seconds a row can wait in memory before the batch is committed anyway
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+MEDIA_TABLES = ('movie_details', 'serie_details')
+# full text index kept in sync with every media table by triggers
+SEARCH_TABLES = {'movie_details': 'movie_search', 'serie_details': 'serie_search'}
+# year of release_date ('2008-01-20' or '2008'), computed by sqlite so it can be indexed
+RELEASE_YEAR_COLUMN = ("release_year INTEGER GENERATED ALWAYS AS (CASE WHEN substr(release_date, 1, 4) "
+                       "GLOB '[0-9][0-9][0-9][0-9]' THEN CAST(substr(release_date, 1, 4) AS INTEGER) END) VIRTUAL")
+# first country of the comma separated list, the leaderboards filter on it instead of scanning with LIKE
+PRIMARY_COUNTRY_COLUMN = ("primary_country TEXT GENERATED ALWAYS AS (CASE WHEN instr(countries, ',') "
+                          "THEN substr(countries, 1, instr(countries, ',') - 1) ELSE countries END) VIRTUAL")
+# voters with unrated titles (NULL) as -1, the / listing sorts on it: they come last and,
+# unlike NULL, the value compares in the keyset condition of the next page
+UNRATED_VOTERS = -1
+SORTED_VOTERS_COLUMN = f"sorted_voters INTEGER GENERATED ALWAYS AS (IFNULL(voters, {UNRATED_VOTERS})) VIRTUAL"
+# filter of the /movies and /series leaderboards. the partial index below is only used by queries
+# repeating these exact terms, so the api builds its WHERE clause from this string
+LEADERBOARD_MIN_VOTERS = 10000
+LEADERBOARD_EXCLUDED_COUNTRY = 'India'
+LEADERBOARD_FILTER = f"voters > {LEADERBOARD_MIN_VOTERS} AND primary_country <> '{LEADERBOARD_EXCLUDED_COUNTRY}'"
+# refresh bookkeeping of every title:
+# scraped_at     last time the page was fetched and checked, epoch seconds
+# refresh_after  the refresh scheduler fetches the title again once this time has passed
+# change_seq     taken from CHANGE_COUNTERS on every insert and on every update that changed a data column,
+#                exports resume from it
+# content_hash   sha256 of the ld+json block of the last fetched page
+# etag, last_modified  validators sent back in the conditional request
+REFRESH_COLUMNS = (('scraped_at', 'INTEGER'), ('refresh_after', 'INTEGER'), ('change_seq', 'INTEGER'),
+                   ('content_hash', 'TEXT'), ('etag', 'TEXT'), ('last_modified', 'TEXT'))
+DAY = 24 * 60 * 60
+# titles released this many years ago or later are refreshed every NEW_RELEASE_INTERVAL
+NEW_RELEASE_YEARS = 1
+NEW_RELEASE_INTERVAL = DAY
+POPULAR_VOTERS = 100000
+POPULAR_INTERVAL = 3 * DAY
+KNOWN_INTERVAL = 7 * DAY
+DEFAULT_REFRESH_INTERVAL = 30 * DAY
+# last change_seq handed out per media table. MAX(change_seq) + 1 would hand out a number again
+# once the row holding the maximum is rewritten, and the export would skip the change
+CHANGE_COUNTERS = 'change_counters'
+
+# movies and series in one relation, kind tells them apart
+MEDIA_VIEW = 'media'
+MEDIA_KINDS = {'movie_details': 'movie', 'serie_details': 'serie'}
+_MEDIA_CLASSES = (ImdbMovie, ImdbSerie)
+MEDIA_VIEW_COLUMNS = tuple(dict.fromkeys(
+    itertools.chain(*(_media_class.COLUMNS for _media_class in _MEDIA_CLASSES),
+                    ('release_year', 'primary_country', 'scraped_at'))))
+
+_STOP = object()
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+def connect(_database_location):
+    _connection = sqlite3.connect(_database_location)
+    # WAL lets the api and the lookups keep reading while the crawler writes
+    _connection.execute('PRAGMA journal_mode=WAL')
+    _connection.execute('PRAGMA synchronous=NORMAL')
+    return _connection
+
+
+def _table_columns(_connection, _table):
+    return {_row[1] for _row in _connection.execute(f'PRAGMA table_xinfo({_table})')}
+
+
+def _table_exists(_connection, _table):
+    return _connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                               (_table,)).fetchone() is not None
+
+
+def _create_search_table(_connection, _table, _search_table):
+    # external content table: the index reads title and original_title back from _table by rowid,
+    # the text is not stored twice. tables created before that are rebuilt
+    _row = _connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                               (_search_table,)).fetchone()
+    if _row is not None:
+        if 'content=' in _row[0]:
+            return
+        _connection.execute(f'DROP TABLE {_search_table}')
+        my_logger.info(f'{_search_table} stored its own copy of the titles, rebuilding it')
+    _content = f"content='{_table}', content_rowid='rowid'"
+    try:
+        # trigram tokens keep the substring semantics of the old title LIKE "%...%"
+        _connection.execute(f"CREATE VIRTUAL TABLE {_search_table} USING fts5(title, original_title, {_content}, "
+                            f"tokenize='trigram')")
+    except sqlite3.OperationalError:
+        my_logger.warn(f'sqlite {sqlite3.sqlite_version} has no trigram tokenizer, {_search_table} matches words')
+        _connection.execute(f'CREATE VIRTUAL TABLE {_search_table} USING fts5(title, original_title, {_content})')
+    _connection.execute(f"INSERT INTO {_search_table} ({_search_table}) VALUES ('rebuild')")
+    my_logger.info(f'{_search_table} created')
+
+
+def _create_search_triggers(_connection, _table, _search_table):
+    # an external content index only drops a row given the values it was indexed with, hence the 'delete'
+    # command with the old title and original_title.
+    # rows are never replaced (INSERT OR REPLACE would skip the delete trigger), existing ones go through
+    # the upsert, which fires the update trigger
+    _delete = f"INSERT INTO {_search_table} ({_search_table}, rowid, title, original_title)"
+    _insert = f"INSERT INTO {_search_table} (rowid, title, original_title) VALUES (NEW.rowid, NEW.title, NEW.original_title);"
+    # an upsert also fires BEFORE INSERT, the entry would be deleted twice
+    _connection.execute(f'DROP TRIGGER IF EXISTS {_search_table}_before_insert')
+    _triggers = {
+        'after_insert': f"""AFTER INSERT ON {_table} BEGIN
+            {_insert}
+        END""",
+        'after_update': f"""AFTER UPDATE OF title, original_title ON {_table} BEGIN
+            {_delete} VALUES ('delete', OLD.rowid, OLD.title, OLD.original_title);
+            {_insert}
+        END""",
+        'after_delete': f"""AFTER DELETE ON {_table} BEGIN
+            {_delete} VALUES ('delete', OLD.rowid, OLD.title, OLD.original_title);
+        END""",
+    }
+    for _event, _body in _triggers.items():
+        _name = f'{_search_table}_{_event}'
+        _create_schema_object(_connection, 'trigger', _name, f'CREATE TRIGGER {_name} {_body}')
+
+
+def _create_schema_object(_connection, _type, _name, _sql):
+    # an index, view or trigger whose definition changed is rebuilt, IF NOT EXISTS alone would keep the old one
+    _row = _connection.execute('SELECT sql FROM sqlite_master WHERE type = ? AND name = ?', (_type, _name)).fetchone()
+    if _row is not None and _row[0] == _sql:
+        return
+    if _row is not None:
+        _connection.execute(f'DROP {_type.upper()} {_name}')
+        my_logger.info(f'{_name} definition changed, rebuilding it')
+    _connection.execute(_sql)
+
+
+def _create_index(_connection, _name, _sql):
+    _create_schema_object(_connection, 'index', _name, _sql)
+
+
+def _create_indexes(_connection, _table):
+    _create_index(_connection, f'{_table}_release_year',
+                  f'CREATE INDEX {_table}_release_year ON {_table} (release_year)')
+    # /, most voted first. imdb_id breaks the ties so a page can resume after any row (keyset pagination)
+    _create_index(_connection, f'{_table}_popular',
+                  f'CREATE INDEX {_table}_popular ON {_table} (sorted_voters DESC, score DESC, imdb_id DESC)')
+    # /movies and /series, only the rows passing the filter are indexed, already in leaderboard order
+    _create_index(_connection, f'{_table}_leaderboard',
+                  f'CREATE INDEX {_table}_leaderboard ON {_table} (score DESC, voters DESC, imdb_id DESC) '
+                  f'WHERE {LEADERBOARD_FILTER}')
+
+
+def _media_columns(_table):
+    return next(_media_class for _media_class in _MEDIA_CLASSES if _media_class.TABLE_NAME == _table).COLUMNS
+
+
+def media_projection(_table, _alias=None):
+    # select list of one media table in the column order of the media view, missing columns are NULL
+    _table_columns = set(_media_columns(_table)) | {'release_year', 'primary_country', 'scraped_at'}
+    _prefix = f'{_alias}.' if _alias else ''
+    _columns = ', '.join(f'{_prefix}{_column}' if _column in _table_columns else f'NULL AS {_column}'
+                         for _column in MEDIA_VIEW_COLUMNS)
+    return f"'{MEDIA_KINDS[_table]}' AS kind, {_columns}"
+
+
+def refresh_interval_sql(_prefix=''):
+    # seconds until the next refresh, evaluated by sqlite on the row (_prefix 'NEW.' inside a trigger).
+    # text sorts above every number in sqlite, a voters value that is not an integer counts as unrated
+    _voters = f"(CASE WHEN typeof({_prefix}voters) = 'integer' THEN {_prefix}voters END)"
+    return (f"(CASE WHEN {_prefix}release_year >= CAST(strftime('%Y', 'now') AS INTEGER) - {NEW_RELEASE_YEARS} "
+            f"THEN {NEW_RELEASE_INTERVAL} WHEN {_voters} >= {POPULAR_VOTERS} THEN {POPULAR_INTERVAL} "
+            f"WHEN {_voters} > {LEADERBOARD_MIN_VOTERS} THEN {KNOWN_INTERVAL} "
+            f"ELSE {DEFAULT_REFRESH_INTERVAL} END)")
+
+
+def _next_change_seq_sql(_table):
+    # trigger body statements, the row gets the next number of the table's counter.
+    # sqlite runs one write transaction at a time, the numbers follow the commit order
+    return (f"UPDATE {CHANGE_COUNTERS} SET seq = seq + 1 WHERE table_name = '{_table}';\n"
+            f"            UPDATE {_table} SET change_seq = (SELECT seq FROM {CHANGE_COUNTERS} "
+            f"WHERE table_name = '{_table}') WHERE rowid = NEW.rowid;")
+
+
+def _create_change_counter(_connection, _table):
+    _connection.execute(f'CREATE TABLE IF NOT EXISTS {CHANGE_COUNTERS} (table_name TEXT NOT NULL PRIMARY KEY, '
+                        f'seq INTEGER NOT NULL)')
+    # never behind the numbers already stored, the counter only moves forward
+    _connection.execute(f'INSERT INTO {CHANGE_COUNTERS} (table_name, seq) '
+                        f'SELECT ?, COALESCE(MAX(change_seq), 0) FROM {_table} WHERE true '
+                        f'ON CONFLICT(table_name) DO UPDATE SET seq = max(seq, excluded.seq)', (_table,))
+
+
+def _normalise_voters(_connection, _table):
+    # unrated titles used to be stored with voters 'NA', they are NULL now.
+    # 'NA' compared above any number, the leaderboards and the refresh priority took them for popular titles
+    # text sorts after every number, the popular index finds those rows without a scan of the table
+    _connection.execute(f"UPDATE {_table} SET voters = NULL WHERE sorted_voters >= ''")
+
+
+def _add_refresh_columns(_connection, _table):
+    _columns = _table_columns(_connection, _table)
+    _added = False
+    for _column, _type in REFRESH_COLUMNS:
+        if _column not in _columns:
+            _connection.execute(f'ALTER TABLE {_table} ADD COLUMN {_column} {_type}')
+            _added = True
+    _create_index(_connection, f'{_table}_change_seq', f'CREATE INDEX {_table}_change_seq ON {_table} (change_seq)')
+    # due titles, most overdue first and the most voted first among titles due at the same time
+    _create_index(_connection, f'{_table}_refresh',
+                  f'CREATE INDEX {_table}_refresh ON {_table} (refresh_after, voters DESC)')
+    if _added:
+        # rows stored before the bookkeeping existed are due now, their rowid keeps the export order
+        _connection.execute(f'UPDATE {_table} SET change_seq = rowid, refresh_after = 0 WHERE change_seq IS NULL')
+    _create_change_counter(_connection, _table)
+    # a replayed page keeps the time it was fetched, the next refresh is counted from then
+    _scraped_at = "COALESCE(NEW.scraped_at, CAST(strftime('%s', 'now') AS INTEGER))"
+    _create_schema_object(_connection, 'trigger', f'{_table}_refresh_after_insert', f"""CREATE TRIGGER {_table}_refresh_after_insert AFTER INSERT ON {_table} BEGIN
+            UPDATE {_table} SET scraped_at = {_scraped_at}, refresh_after = {_scraped_at} + {refresh_interval_sql('NEW.')}
+            WHERE rowid = NEW.rowid;
+            {_next_change_seq_sql(_table)}
+        END""")
+    # the refresher and the upsert of replay() write the data columns, only a value that differs is a change
+    _data_columns = [_column for _column in _media_columns(_table) if _column != 'imdb_id']
+    _changed = ' OR '.join(f'OLD.{_column} IS NOT NEW.{_column}' for _column in _data_columns)
+    _create_schema_object(_connection, 'trigger', f'{_table}_change_seq_after_update', f"""CREATE TRIGGER {_table}_change_seq_after_update AFTER UPDATE OF {', '.join(_data_columns)} ON {_table}
+        WHEN {_changed} BEGIN
+            {_next_change_seq_sql(_table)}
+        END""")
+
+
+def _media_view_sql():
+    # UNION ALL, sqlite pushes the WHERE terms down into both selects and keeps using their primary keys
+    _selects = [f'SELECT {media_projection(_table)} FROM {_table}' for _table in MEDIA_TABLES]
+    return f'CREATE VIEW {MEDIA_VIEW} AS {" UNION ALL ".join(_selects)}'
+
+
+def migrate_database(_database_location):
+    # brings an existing database up to the current schema, safe to run on every start
+    _connection = sqlite3.connect(_database_location)
+    try:
+        for _table in MEDIA_TABLES:
+            if not _table_exists(_connection, _table):
+                continue
+            if 'release_year' not in _table_columns(_connection, _table):
+                _connection.execute(f'ALTER TABLE {_table} ADD COLUMN {RELEASE_YEAR_COLUMN}')
+            if 'primary_country' not in _table_columns(_connection, _table):
+                _connection.execute(f'ALTER TABLE {_table} ADD COLUMN {PRIMARY_COUNTRY_COLUMN}')
+            if 'sorted_voters' not in _table_columns(_connection, _table):
+                _connection.execute(f'ALTER TABLE {_table} ADD COLUMN {SORTED_VOTERS_COLUMN}')
+            _create_indexes(_connection, _table)
+            _normalise_voters(_connection, _table)
+            _add_refresh_columns(_connection, _table)
+            _create_search_table(_connection, _table, SEARCH_TABLES[_table])
+            _create_search_triggers(_connection, _table, SEARCH_TABLES[_table])
+        if all(_table_exists(_connection, _table) for _table in MEDIA_TABLES):
+            _create_schema_object(_connection, 'view', MEDIA_VIEW, _media_view_sql())
+        _connection.commit()
+    finally:
+        _connection.close()
+
+
+def search_query(_text):
+    # the text is matched as one phrase, fts operators typed by the user are not interpreted
+    return '"{}"'.format(_text.replace('"', '""'))
+
+
+# ids already stored in the database, checked before fetching a page.
+# ids found at startup are kept as a sorted array of tt numbers (8 bytes per id),
+# ids inserted afterwards go to a small set until the next load.
+class KnownIds:
+
+    def __init__(self, _database_location):
+        self.database_location = _database_location
+        self._lock = threading.Lock()
+        self._sorted_ids = array('q')
+        self._new_ids = set()
+        self.load()
+
+    def load(self):
+        _connection = sqlite3.connect(self.database_location)
+        _numbers = []
+        for _table in MEDIA_TABLES:
+            try:
+                _rows = _connection.execute(f'SELECT imdb_id FROM {_table}')
+            except sqlite3.OperationalError:
+                continue
+            for (_imdb_id,) in _rows:
+                try:
+                    _numbers.append(imdb_id_to_int(_imdb_id))
+                except ValueError:
+                    my_logger.warn(f'{_imdb_id} is not a valid imdb id')
+        _connection.close()
+        _numbers.sort()
+        with self._lock:
+            self._sorted_ids = array('q', _numbers)
+            self._new_ids = set()
+        my_logger.info(f'{len(self._sorted_ids)} known ids loaded')
+
+    def add(self, _imdb_id):
+        with self._lock:
+            self._new_ids.add(imdb_id_to_int(_imdb_id))
+
+    def on_commit(self, _rows):
+        # DatabaseWriter callback, the imdb_id is the first column of every media table
+        for _statement, _parameters in _rows:
+            self.add(_parameters[0])
+
+    def __contains__(self, _imdb_id):
+        try:
+            _number = imdb_id_to_int(_imdb_id)
+        except ValueError:
+            return False
+        if _number in self._new_ids:
+            return True
+        _index = bisect.bisect_left(self._sorted_ids, _number)
+        return _index < len(self._sorted_ids) and self._sorted_ids[_index] == _number
+
+    def __len__(self):
+        return len(self._sorted_ids) + len(self._new_ids)
+
+
+class DatabaseWriter:
+    def __init__(self, _database_location, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 on_commit=None):
+        self.database_location = _database_location
+        # called from the writer thread with the (statement, parameters) rows of every successful commit
+        self.on_commit = on_commit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.commits = 0
+        self.total_commit_time = 0.0
+        self.max_commit_time = 0.0
+        self.last_commit_time = 0.0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='DatabaseWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def insert(self, _statement, _parameters):
+        if self._closed:
+            raise RuntimeError('DatabaseWriter is closed')
+        self._queue.put((_statement, tuple(_parameters)))
+
+    def add(self, _media, upsert=False, scraped_at=None):
+        _statement, _parameters = _media.insertion_parameters(upsert, scraped_at)
+        self.insert(_statement, _parameters)
+
+    def flush(self):
+        # blocks until every row queued before this call is committed
+        _done = threading.Event()
+        self._queue.put(_done)
+        _done.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        my_logger.info(f'DatabaseWriter closed, {self.report()}')
+
+    def stats(self):
+        return {
+            'rows_written': self.rows_written,
+            'rows_failed': self.rows_failed,
+            'commits': self.commits,
+            'pending': self._queue.qsize(),
+            'last_commit_ms': self.last_commit_time * 1000,
+            'avg_commit_ms': (self.total_commit_time / self.commits * 1000) if self.commits else 0.0,
+            'max_commit_ms': self.max_commit_time * 1000,
+        }
+
+    def report(self):
+        _stats = self.stats()
+        return (f'rows written: {_stats["rows_written"]}, rows failed: {_stats["rows_failed"]}, '
+                f'commits: {_stats["commits"]}, avg commit: {_stats["avg_commit_ms"]:.2f} ms, '
+                f'max commit: {_stats["max_commit_ms"]:.2f} ms')
+
+    def _run(self):
+        _connection = connect(self.database_location)
+        _pending = []
+        _deadline = None
+        while True:
+            _timeout = None if _deadline is None else max(0.0, _deadline - time.monotonic())
+            try:
+                _item = self._queue.get(timeout=_timeout)
+            except queue.Empty:
+                _item = None
+            if _item is _STOP or isinstance(_item, threading.Event):
+                self._commit(_connection, _pending)
+                _pending, _deadline = [], None
+                if _item is _STOP:
+                    break
+                _item.set()
+                continue
+            if _item is not None:
+                _pending.append(_item)
+                if _deadline is None:
+                    _deadline = time.monotonic() + self.flush_interval
+            # a timeout means the oldest pending row waited flush_interval seconds
+            if _item is None or len(_pending) >= self.batch_size:
+                self._commit(_connection, _pending)
+                _pending, _deadline = [], None
+        _connection.close()
+
+    def _commit(self, _connection, _pending):
+        if not _pending:
+            return
+        _start = time.perf_counter()
+        try:
+            with _connection:
+                # consecutive rows for the same table share one prepared statement
+                for _statement, _rows in itertools.groupby(_pending, key=lambda _row: _row[0]):
+                    _connection.executemany(_statement, [_row[1] for _row in _rows])
+            self.rows_written += len(_pending)
+            self._notify(_pending)
+        except sqlite3.Error as e:
+            my_logger.warn(f'batch of {len(_pending)} rows failed, retrying one by one: {e}')
+            self._commit_one_by_one(_connection, _pending)
+        _elapsed = time.perf_counter() - _start
+        self.commits += 1
+        self.last_commit_time = _elapsed
+        self.total_commit_time += _elapsed
+        self.max_commit_time = max(self.max_commit_time, _elapsed)
+
+    def _commit_one_by_one(self, _connection, _pending):
+        for _statement, _parameters in _pending:
+            try:
+                with _connection:
+                    _connection.execute(_statement, _parameters)
+                self.rows_written += 1
+                self._notify([(_statement, _parameters)])
+            except sqlite3.Error as e:
+                my_logger.warn(_statement)
+                my_logger.warn(e)
+                self.rows_failed += 1
+
+    def _notify(self, _rows):
+        if self.on_commit is None:
+            return
+        try:
+            self.on_commit(_rows)
+        except Exception as e:
+            my_logger.warn(f'on_commit callback failed: {e!r}')
@@ -0,0 +1,177 @@
+# Streaming NDJSON export of the media tables, one json document per line for mongoimport.
+# rows are read in chunks with fetchmany, memory use does not grow with the size of the database
+import argparse
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from dataclass.imdb import ImdbMovie, ImdbSerie
+from imdb_database import MEDIA_KINDS, migrate_database
+from imdb_scrapper import DATABASE_LOCATION
+
+try:
+    import resource
+except ImportError:
+    # windows, the peak memory is not reported
+    resource = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+################################################################################
+
+CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# change_seq of the last exported row per table, read and written by incremental exports
+WATERMARK_PATH = os.path.join(CURRENT_DIR_PATH, 'data', 'export_watermark.json')
+# rows fetched from sqlite at a time
+DEFAULT_CHUNK_SIZE = 1000
+# model the documents are mapped to on the mongodb side
+EXPORT_CLASS = 'com.back_sync.models.Imdb'
+EXPORTED_MEDIA = (ImdbMovie, ImdbSerie)
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+class ExportStats:
+    def __init__(self):
+        self.rows = {}
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add(self, _table, _rows):
+        self.rows[_table] = self.rows.get(_table, 0) + _rows
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started_at
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.values())
+
+    @staticmethod
+    def peak_memory_mb():
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def report(self):
+        _rate = self.total_rows / self.elapsed if self.elapsed else 0.0
+        _tables = ', '.join(f'{_table}: {_rows}' for _table, _rows in self.rows.items())
+        _peak = self.peak_memory_mb()
+        _memory = f', peak memory {_peak:.1f} MB' if _peak is not None else ''
+        return f'{self.total_rows} rows exported ({_tables}) in {self.elapsed:.1f} s, {_rate:.0f} rows/sec{_memory}'
+
+
+def read_watermark(_watermark_path=WATERMARK_PATH):
+    try:
+        with open(_watermark_path, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_watermark(_watermark, _watermark_path=WATERMARK_PATH):
+    # written under a temporary name, a crash never leaves a half written watermark
+    os.makedirs(os.path.dirname(_watermark_path) or '.', exist_ok=True)
+    _temp_path = f'{_watermark_path}.tmp'
+    with open(_temp_path, 'w', encoding='utf-8') as file:
+        json.dump(_watermark, file)
+    os.replace(_temp_path, _watermark_path)
+
+
+def open_output(_output_path, compression=None):
+    # compression is inferred from the extension unless given: .gz, .zst or plain text
+    if compression is None:
+        compression = {'.gz': 'gzip', '.zst': 'zstd'}.get(os.path.splitext(_output_path)[1])
+    os.makedirs(os.path.dirname(_output_path) or '.', exist_ok=True)
+    match compression:
+        case 'gzip':
+            return gzip.open(_output_path, 'wt', encoding='utf-8', compresslevel=6)
+        case 'zstd':
+            if zstandard is None:
+                raise RuntimeError('zstd compression needs the zstandard package')
+            return zstandard.open(_output_path, 'wt', encoding='utf-8')
+        case None:
+            return open(_output_path, 'w', encoding='utf-8')
+        case _:
+            raise ValueError(f'unknown compression {compression}')
+
+
+def export_table(_connection, _media_class, _outfile, _stats, _after_change=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    # returns the change_seq of the last exported row.
+    # inserts and updates that changed a data column (refreshes, replay) all get a new change_seq.
+    # rows stored before change_seq existed got their rowid, watermarks written by the rowid based export stay valid
+    _table = _media_class.TABLE_NAME
+    _columns = _media_class.COLUMNS
+    _cursor = _connection.execute(
+        f'SELECT change_seq, {", ".join(_columns)} FROM {_table} WHERE change_seq > ? ORDER BY change_seq',
+        (_after_change,))
+    _last_change = _after_change
+    while True:
+        _rows = _cursor.fetchmany(chunk_size)
+        if not _rows:
+            break
+        _lines = []
+        for _row in _rows:
+            _document = dict(zip(_columns, _row[1:]))
+            _document['kind'] = MEDIA_KINDS[_table]
+            _document['_class'] = EXPORT_CLASS
+            _lines.append(json.dumps(_document, ensure_ascii=False))
+        _outfile.write('\n'.join(_lines))
+        _outfile.write('\n')
+        _last_change = _rows[-1][0]
+        _stats.add(_table, len(_rows))
+    _cursor.close()
+    return _last_change
+
+
+def export_media(_output_path, database_location=DATABASE_LOCATION, incremental=False, compression=None,
+                 watermark_path=WATERMARK_PATH, chunk_size=DEFAULT_CHUNK_SIZE):
+    # full export, or only the rows inserted or changed since the last incremental export
+    migrate_database(database_location)
+    _watermark = read_watermark(watermark_path) if incremental else {}
+    _stats = ExportStats()
+    _connection = sqlite3.connect(database_location)
+    try:
+        # one read transaction, both tables are exported from the same snapshot while the crawler keeps writing
+        _connection.execute('BEGIN')
+        with open_output(_output_path, compression) as outfile:
+            for _media_class in EXPORTED_MEDIA:
+                _table = _media_class.TABLE_NAME
+                _watermark[_table] = export_table(_connection, _media_class, outfile, _stats,
+                                                  _watermark.get(_table, 0), chunk_size)
+        _connection.rollback()
+    finally:
+        _connection.close()
+    # only moved forward once the export file is complete
+    if incremental:
+        write_watermark(_watermark, watermark_path)
+    _stats.finish()
+    my_logger.info(_stats.report())
+    return _stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export the movies and series as ndjson')
+    parser.add_argument('output', help='file to write, a .gz or .zst extension compresses it')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export the rows inserted or changed since the last incremental export')
+    parser.add_argument('--compression', choices=('gzip', 'zstd'), default=None,
+                        help='compression of the output, inferred from the extension by default')
+    parser.add_argument('--watermark', default=WATERMARK_PATH,
+                        help='file keeping the position of the last incremental export')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='rows fetched from sqlite at a time')
+    args = parser.parse_args()
+    print(export_media(args.output, incremental=args.incremental, compression=args.compression,
+                       watermark_path=args.watermark, chunk_size=args.chunk_size).report())
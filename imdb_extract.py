@@ -0,0 +1,191 @@
+# Fast path extractor, reads the ld+json and Next.js payloads straight from the raw html.
+# a BeautifulSoup tree is only built when one of the fields is missing from the embedded json.
+import json
+import re
+from collections import Counter
+
+from bs4 import BeautifulSoup
+from imdb_scrapper import (COUNTRIES_PROFILER, clean_creator, clean_text, extract_details, find_json_value,
+                           parse_countries)
+
+
+################################################################################
+
+_LD_JSON_PATTERN = re.compile(r'<script type="application/ld\+json">(.*?)</script>', re.S)
+
+# principalCredits category names
+STARS_CATEGORIES = ('Stars', 'Star')
+DIRECTOR_CATEGORIES = ('Directors', 'Director')
+CREATOR_CATEGORIES = ('Creators', 'Creator')
+
+# fields looked up in the embedded json, per media type
+MOVIE_FIELDS = ('title', 'voters', 'rated', 'release_date', 'countries', 'genre', 'actors', 'director')
+SERIE_FIELDS = ('title', 'voters', 'rated', 'release_date', 'countries', 'genre', 'actors', 'creator',
+                'seasons', 'runtime', 'years')
+
+
+################################################################################
+
+
+class LazySoup:
+    # stands in for the soup handed to the getters, the tree is only built on first use
+
+    def __init__(self, _html):
+        self._html = _html
+        self._soup = None
+
+    @property
+    def built(self):
+        return self._soup is not None
+
+    def __getattr__(self, _name):
+        if self._soup is None:
+            self._soup = BeautifulSoup(self._html, 'lxml')
+        return getattr(self._soup, _name)
+
+    def __str__(self):
+        # the regex fallbacks only need the text, no need to build and re-serialise the tree
+        return self._html
+
+
+def get_ld_json_text(_html):
+    _match = _LD_JSON_PATTERN.search(_html)
+    return _match.group(1) if _match else None
+
+
+def get_ld_json(_html):
+    _text = get_ld_json_text(_html)
+    if _text is None:
+        return False
+    try:
+        return json.loads(_text)
+    except json.decoder.JSONDecodeError:
+        return False
+
+
+def _credits(_principal_credits, _categories):
+    for _credit in _principal_credits or []:
+        if _credit.get('category', {}).get('text') in _categories:
+            _names = [_person['name']['nameText']['text'] for _person in _credit.get('credits', [])]
+            if _names:
+                return ', '.join(_names)
+    return None
+
+
+def _title(_html, _media_info):
+    return clean_text(find_json_value(_html, 'titleText')['text'])
+
+
+def _voters(_html, _media_info):
+    return int(_media_info['aggregateRating']['ratingCount'])
+
+
+def _rated(_html, _media_info):
+    return _media_info['contentRating']
+
+
+def _release_date(_html, _media_info):
+    return _media_info['datePublished']
+
+
+def _countries(_html, _media_info):
+    return ', '.join(parse_countries(_html)) or None
+
+
+def _genre(_html, _media_info):
+    return ', '.join(_media_info['genres'])
+
+
+def _actors(_html, _media_info):
+    return _credits(find_json_value(_html, 'principalCredits'), STARS_CATEGORIES)
+
+
+def _director(_html, _media_info):
+    if 'directors' in _media_info:
+        return clean_creator(_media_info['directors'])
+    return _credits(find_json_value(_html, 'principalCredits'), DIRECTOR_CATEGORIES)
+
+
+def _creator(_html, _media_info):
+    if 'creators' in _media_info:
+        return clean_creator(_media_info['creators'])
+    return _credits(find_json_value(_html, 'principalCredits'), CREATOR_CATEGORIES)
+
+
+def _seasons(_html, _media_info):
+    _seasons_list = find_json_value(_html, 'seasons')
+    if not isinstance(_seasons_list, list) or not all('value' in _season for _season in _seasons_list):
+        return None
+    return len(_seasons_list) or None
+
+
+def _runtime(_html, _media_info):
+    return find_json_value(_html, 'runtime')['displayableProperty']['value']['plainText']
+
+
+def _years(_html, _media_info):
+    _release_year = find_json_value(_html, 'releaseYear')
+    return f"{_release_year['year']}–{_release_year.get('endYear') or ''}"
+
+
+FAST_GETTERS = {
+    'title': _title,
+    'voters': _voters,
+    'rated': _rated,
+    'release_date': _release_date,
+    'countries': _countries,
+    'genre': _genre,
+    'actors': _actors,
+    'director': _director,
+    'creator': _creator,
+    'seasons': _seasons,
+    'runtime': _runtime,
+    'years': _years,
+}
+
+
+def get_fast_values(_html, _media_info, _fields):
+    _values = {}
+    for _field in _fields:
+        try:
+            _values[_field] = FAST_GETTERS[_field](_html, _media_info)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            _values[_field] = None
+    return _values
+
+
+def parse_html_fast(_imdb_id, _html):
+    # returns (details, fields that fell back to the soup selectors, countries strategy samples).
+    # in a process pool worker the samples would stay in the worker's profiler, they go back with the result
+    media_info = get_ld_json(_html)
+    if not media_info:
+        return False, [], COUNTRIES_PROFILER.drain()
+    match media_info.get('@type'):
+        case 'Movie':
+            _fields = MOVIE_FIELDS
+        case 'TVSeries':
+            _fields = SERIE_FIELDS
+        case _:
+            # skipped by extract_details, nothing worth extracting
+            return extract_details(_imdb_id, LazySoup(_html), media_info), [], COUNTRIES_PROFILER.drain()
+    _fast_values = get_fast_values(_html, media_info, _fields)
+    details = extract_details(_imdb_id, LazySoup(_html), media_info, _fast_values)
+    return details, [_field for _field, _value in _fast_values.items() if _value is None], COUNTRIES_PROFILER.drain()
+
+
+class FallbackStats:
+    def __init__(self):
+        self.pages = 0
+        self.pages_with_fallback = 0
+        self.fields = Counter()
+
+    def record(self, _fallbacks):
+        self.pages += 1
+        if _fallbacks:
+            self.pages_with_fallback += 1
+            self.fields.update(_fallbacks)
+
+    def report(self):
+        _rate = (self.pages_with_fallback / self.pages * 100) if self.pages else 0.0
+        _fields = ', '.join(f'{_field}: {_count}' for _field, _count in self.fields.most_common())
+        return f'soup fallback on {_rate:.1f}% of pages ({_fields or "none"})'
@@ -0,0 +1,109 @@
+# Shared http session, every page fetch reuses pooled keep-alive connections
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # requests only decodes brotli responses when one of these is installed
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = 'gzip, deflate, br'
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip, deflate'
+
+
+################################################################################
+
+# connections kept open to www.imdb.com, match it to the number of threads fetching at the same time.
+# configure_session() sets it for the process: 1 for the sequential crawl and the refresher,
+# the scraper pool size in the api
+DEFAULT_POOL_SIZE = 32
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+HEADERS = {
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Connection': 'keep-alive',
+}
+
+my_logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+_timeout = DEFAULT_TIMEOUT
+
+
+################################################################################
+
+
+class FetchTimings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+
+    def record(self, _elapsed):
+        with self._lock:
+            self.requests += 1
+            self.total_time += _elapsed
+            self.max_time = max(self.max_time, _elapsed)
+            self.last_time = _elapsed
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'last_ms': self.last_time * 1000,
+            'avg_ms': (self.total_time / self.requests * 1000) if self.requests else 0.0,
+            'max_ms': self.max_time * 1000,
+        }
+
+
+FETCH_TIMINGS = FetchTimings()
+
+
+def _build_session(_pool_size):
+    _new_session = requests.Session()
+    _adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_pool_size, pool_block=True)
+    _new_session.mount('https://', _adapter)
+    _new_session.mount('http://', _adapter)
+    _new_session.headers.update(HEADERS)
+    return _new_session
+
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+    global _session, _timeout
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = _build_session(pool_size)
+        _timeout = timeout
+    return _session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session(DEFAULT_POOL_SIZE)
+    return _session
+
+
+def fetch(_link, timeout=None, headers=None):
+    # body is read before the timer stops so the timing covers the whole transfer.
+    # headers are added to the session ones, e.g. the validators of a conditional request
+    _start = time.perf_counter()
+    _response = get_session().get(_link, timeout=timeout or _timeout, headers=headers)
+    _response.content
+    _elapsed = time.perf_counter() - _start
+    FETCH_TIMINGS.record(_elapsed)
+    my_logger.debug(f'{_link} {_response.status_code} in {_elapsed * 1000:.0f} ms')
+    return _response
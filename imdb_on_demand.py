@@ -0,0 +1,106 @@
+# On demand scrapes for the api, run in a small thread pool so the event loop never blocks on them.
+# concurrent requests for the same id share one scrape (single flight)
+import asyncio
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+
+################################################################################
+
+# scrapes running at the same time, each one holds a connection to imdb and maybe a browser
+DEFAULT_MAX_CONCURRENT = 4
+# scrapes accepted but not finished, running ones included. beyond that new ids are refused
+DEFAULT_MAX_PENDING = 100
+# seconds a request waits for its scrape before it gets a 202 instead
+DEFAULT_TIMEOUT = 20
+
+VALID_IMDB_ID = re.compile(r'tt\d{7,8}')
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+class ScrapeQueueFull(Exception):
+    pass
+
+
+class OnDemandScraper:
+    def __init__(self, _scrape, max_concurrent=DEFAULT_MAX_CONCURRENT, max_pending=DEFAULT_MAX_PENDING,
+                 timeout=DEFAULT_TIMEOUT):
+        # _scrape(imdb_id) is blocking, it runs in one of the pool threads
+        self.scrape = _scrape
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.started = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.refused = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='OnDemandScraper')
+        self._in_flight = {}
+
+    @staticmethod
+    def is_valid(_imdb_id):
+        return VALID_IMDB_ID.fullmatch(_imdb_id) is not None
+
+    def is_pending(self, _imdb_id):
+        return _imdb_id in self._in_flight
+
+    def submit(self, _imdb_id):
+        # returns the future of the scrape of _imdb_id, starting it unless one is already running.
+        # must be called from the event loop thread, _in_flight is not locked
+        _future = self._in_flight.get(_imdb_id)
+        if _future is not None:
+            self.coalesced += 1
+            return _future
+        if len(self._in_flight) >= self.max_pending:
+            self.refused += 1
+            raise ScrapeQueueFull(f'{len(self._in_flight)} scrapes pending')
+        _future = asyncio.get_running_loop().run_in_executor(self._executor, self.scrape, _imdb_id)
+        self._in_flight[_imdb_id] = _future
+        self.started += 1
+        _future.add_done_callback(lambda _done: self._done(_imdb_id, _done))
+        return _future
+
+    def _done(self, _imdb_id, _future):
+        self._in_flight.pop(_imdb_id, None)
+        if _future.cancelled():
+            self.failed += 1
+        elif _future.exception() is not None:
+            self.failed += 1
+            my_logger.warn(f'{_imdb_id}, on demand scrape failed: {_future.exception()!r}')
+        else:
+            self.completed += 1
+
+    async def scrape_and_wait(self, _imdb_id, timeout=None):
+        # True once the scrape finished, False if it is still running after the timeout.
+        # the scrape itself is never cancelled, a later request picks up its result from the database
+        _future = self.submit(_imdb_id)
+        try:
+            await asyncio.wait_for(asyncio.shield(_future), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+        except Exception:
+            # already counted and logged by _done
+            pass
+        return True
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'pending': len(self._in_flight),
+            'started': self.started,
+            'coalesced': self.coalesced,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'refused': self.refused,
+        }
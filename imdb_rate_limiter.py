@@ -0,0 +1,147 @@
+# Adaptive request rate, a token bucket whose rate follows AIMD on the origin's responses
+import asyncio
+import logging
+import threading
+import time
+
+
+################################################################################
+
+DEFAULT_INITIAL_RATE = 2.0
+DEFAULT_MIN_RATE = 0.1
+DEFAULT_MAX_RATE = 50.0
+# requests/sec added for every second of healthy responses
+DEFAULT_INCREASE_STEP = 0.5
+# rate multiplier applied on a throttle signal
+DEFAULT_DECREASE_FACTOR = 0.5
+# pause after a throttle signal, doubled for every consecutive one
+DEFAULT_BACKOFF = 10.0
+DEFAULT_MAX_BACKOFF = 240.0
+# a response slower than this many times the average latency counts as a spike
+DEFAULT_LATENCY_SPIKE_FACTOR = 3.0
+# http status codes meaning the origin wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, initial_rate=DEFAULT_INITIAL_RATE, min_rate=DEFAULT_MIN_RATE, max_rate=DEFAULT_MAX_RATE,
+                 increase_step=DEFAULT_INCREASE_STEP, decrease_factor=DEFAULT_DECREASE_FACTOR,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 latency_spike_factor=DEFAULT_LATENCY_SPIKE_FACTOR):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_spike_factor = latency_spike_factor
+        self.average_latency = None
+        self.consecutive_throttles = 0
+        self.successes = 0
+        self.throttles = 0
+        self.last_throttle_reason = None
+        self._tokens = 1.0
+        self._backoff_until = 0.0
+        # bumped by every throttle, reservations taken before it are void
+        self._generation = 0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # takes a token (the bucket may go negative) and returns how long the caller has to wait for it,
+        # with the throttle generation the reservation belongs to
+        with self._lock:
+            _now = time.monotonic()
+            # no tokens are added during a backoff, the bucket starts filling when it ends
+            _start = max(_now, self._backoff_until)
+            if _start > self._last_refill:
+                _burst = max(1.0, self.rate)
+                self._tokens = min(_burst, self._tokens + (_start - self._last_refill) * self.rate)
+                self._last_refill = _start
+            self._tokens -= 1
+            _wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return _start - _now + _wait, self._generation
+
+    def acquire(self):
+        # a throttle while sleeping voids the reservation, it was made at the old rate and before the backoff
+        while True:
+            _wait, _generation = self._reserve()
+            if _wait <= 0:
+                return
+            time.sleep(_wait)
+            if _generation == self._generation:
+                return
+
+    async def acquire_async(self):
+        while True:
+            _wait, _generation = self._reserve()
+            if _wait <= 0:
+                return
+            await asyncio.sleep(_wait)
+            if _generation == self._generation:
+                return
+
+    def on_success(self, _latency=None):
+        with self._lock:
+            self.successes += 1
+            self.consecutive_throttles = 0
+            if _latency is not None:
+                if self.average_latency is not None and \
+                        _latency > self.average_latency * self.latency_spike_factor:
+                    # slow responses come before the 503s, ease off without pausing
+                    self.rate = max(self.min_rate, self.rate * (1 + self.decrease_factor) / 2)
+                    self.average_latency = 0.9 * self.average_latency + 0.1 * _latency
+                    return
+                self.average_latency = _latency if self.average_latency is None \
+                    else 0.9 * self.average_latency + 0.1 * _latency
+            # additive increase, spread over the requests sent in one second
+            self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+
+    def on_throttle(self, _reason):
+        with self._lock:
+            self.throttles += 1
+            self.consecutive_throttles += 1
+            self.last_throttle_reason = _reason
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            _backoff = min(self.max_backoff, self.backoff * 2 ** (self.consecutive_throttles - 1))
+            self._backoff_until = max(self._backoff_until, time.monotonic() + _backoff)
+            # the waiters reserve again after the backoff, their tokens are not owed anymore
+            self._generation += 1
+            self._tokens = 0.0
+            self._last_refill = self._backoff_until
+        my_logger.warn(f'throttled ({_reason}), rate {self.rate:.2f} req/s, backing off {_backoff:.0f} s')
+
+    def record(self, _status_code, _latency=None):
+        if _status_code in THROTTLE_STATUS_CODES:
+            self.on_throttle(f'http {_status_code}')
+            return False
+        self.on_success(_latency)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'tokens': self._tokens,
+                'backoff_remaining': max(0.0, self._backoff_until - time.monotonic()),
+                'consecutive_throttles': self.consecutive_throttles,
+                'successes': self.successes,
+                'throttles': self.throttles,
+                'last_throttle_reason': self.last_throttle_reason,
+                'average_latency_ms': (self.average_latency or 0.0) * 1000,
+            }
+
+    def report(self):
+        _stats = self.stats()
+        return (f'rate: {_stats["rate"]:.2f} req/s, backoff: {_stats["backoff_remaining"]:.0f} s, '
+                f'throttles: {_stats["throttles"]}, avg latency: {_stats["average_latency_ms"]:.0f} ms')
+
+
+# shared by get_html, so main and single_scrape are throttled together
+RATE_LIMITER = AdaptiveRateLimiter()
@@ -0,0 +1,233 @@
+# Keeps score and voters of the stored titles fresh.
+# titles come back in refresh_after order, popular and recent titles get a shorter interval (refresh_interval_sql),
+# requests stay within an hourly budget and only the fields that changed are written,
+# a field missing from the refreshed page keeps its stored value
+import argparse
+import hashlib
+import heapq
+import logging
+import sqlite3
+import time
+from collections import Counter, deque
+
+import requests
+from imdb_database import DAY, MEDIA_TABLES, DatabaseWriter, connect, migrate_database, refresh_interval_sql
+from imdb_extract import get_ld_json_text, parse_html_fast
+from imdb_http import DEFAULT_TIMEOUT, configure_session, fetch
+from imdb_rate_limiter import RATE_LIMITER
+from imdb_scrapper import DATABASE_LOCATION, IMDB_BASE_PATH
+
+
+################################################################################
+
+DEFAULT_REQUESTS_PER_HOUR = 600
+# titles taken from the database at a time, their updates are committed together
+DEFAULT_BATCH_SIZE = 50
+# seconds before a title whose fetch failed or was throttled is tried again
+RETRY_DELAY = 15 * 60
+# a title gone from imdb is only checked again after this long
+GONE_INTERVAL = 90 * DAY
+# seconds to sleep when no title is due
+IDLE_SLEEP = 60
+# what extract_details stores for a field it could not find on the page
+MISSING_VALUES = ('NA', None, -1)
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+class HourlyBudget:
+    # sliding one hour window, wait() blocks while requests_per_hour requests were sent in the last hour
+    def __init__(self, _requests_per_hour):
+        self.requests_per_hour = _requests_per_hour
+        self._sent = deque()
+
+    def wait(self):
+        while True:
+            _now = time.monotonic()
+            while self._sent and self._sent[0] <= _now - 3600:
+                self._sent.popleft()
+            if len(self._sent) < self.requests_per_hour:
+                self._sent.append(_now)
+                return
+            time.sleep(self._sent[0] + 3600 - _now)
+
+
+class RefreshStats:
+    def __init__(self):
+        self.outcomes = Counter()
+        self.fields = Counter()
+
+    def record(self, _outcome, _fields=()):
+        self.outcomes[_outcome] += 1
+        self.fields.update(_fields)
+
+    def report(self):
+        _outcomes = ', '.join(f'{_outcome}: {_count}' for _outcome, _count in self.outcomes.most_common())
+        _fields = ', '.join(f'{_field}: {_count}' for _field, _count in self.fields.most_common())
+        return f'{sum(self.outcomes.values())} titles checked ({_outcomes or "none"}), fields changed ({_fields or "none"})'
+
+
+def _voters(_row):
+    # NULL for unrated titles, and rows migrated from an older database may still hold text
+    _value = _row['voters']
+    return _value if isinstance(_value, int) else 0
+
+
+def _same_value(_stored, _new):
+    # sqlite column affinity turns 3 into '3' in a TEXT column, compare the text of both sides
+    return _stored == _new or (_stored is not None and _new is not None and str(_stored) == str(_new))
+
+
+def _keeps_stored(_column, _stored, _new):
+    # a placeholder from a page that lost a field is a parse miss, not a change, it never replaces real data.
+    # countries that only came back in another order would move primary_country, the first one listed
+    if _new in MISSING_VALUES and _stored not in MISSING_VALUES:
+        return True
+    if _column == 'countries' and _stored and _new and sorted(str(_stored).split(', ')) == sorted(_new.split(', ')):
+        return True
+    return _same_value(_stored, _new)
+
+
+class RefreshScheduler:
+    def __init__(self, _database_location=DATABASE_LOCATION, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        migrate_database(_database_location)
+        self.database_location = _database_location
+        self.batch_size = batch_size
+        self.budget = HourlyBudget(requests_per_hour)
+        self.stats = RefreshStats()
+        self._connection = connect(_database_location)
+        self._connection.row_factory = sqlite3.Row
+        # updates are queued and committed once per batch, the crawler keeps the write lock most of the time
+        self._writer = DatabaseWriter(_database_location, batch_size=batch_size, flush_interval=IDLE_SLEEP)
+
+    def due(self, _limit):
+        # most overdue first over both tables, each one read in its (refresh_after, voters DESC) index order
+        _now = int(time.time())
+        _rows = []
+        for _table in MEDIA_TABLES:
+            _table_rows = self._connection.execute(
+                f'SELECT * FROM {_table} WHERE refresh_after <= ? ORDER BY refresh_after, voters DESC LIMIT ?',
+                (_now, _limit)).fetchall()
+            _rows.append([(_table, _row) for _row in _table_rows])
+        _merged = heapq.merge(*_rows, key=lambda _item: (_item[1]['refresh_after'], -_voters(_item[1])))
+        return list(_merged)[:_limit]
+
+    def _schedule(self, _table, _imdb_id, _delay=None, _changed=False, **_columns):
+        # the columns given, the check time and the next refresh.
+        # _delay None: the interval of the title, from its popularity and release year.
+        # a data column that changed gets the row a new change_seq, from the update trigger of the table
+        _now = int(time.time())
+        _columns['scraped_at'] = _now
+        _assignments = ', '.join(f'{_column} = ?' for _column in _columns)
+        _next = refresh_interval_sql() if _delay is None else str(int(_delay))
+        if not _changed:
+            self._writer.insert(f'UPDATE {_table} SET {_assignments}, refresh_after = ? + {_next} WHERE imdb_id = ?',
+                                (*_columns.values(), _now, _imdb_id))
+            return
+        self._writer.insert(f'UPDATE {_table} SET {_assignments} WHERE imdb_id = ?', (*_columns.values(), _imdb_id))
+        # separate statement, the SET expressions of an UPDATE only see the values from before it
+        self._writer.insert(f'UPDATE {_table} SET refresh_after = ? + {_next} WHERE imdb_id = ?', (_now, _imdb_id))
+
+    def _retry_later(self, _table, _imdb_id):
+        _now = int(time.time())
+        self._writer.insert(f'UPDATE {_table} SET refresh_after = ? WHERE imdb_id = ?', (_now + RETRY_DELAY, _imdb_id))
+
+    def _fetch(self, _row):
+        # conditional request, imdb answers 304 when the validators still match
+        _headers = {}
+        if _row['etag']:
+            _headers['If-None-Match'] = _row['etag']
+        if _row['last_modified']:
+            _headers['If-Modified-Since'] = _row['last_modified']
+        self.budget.wait()
+        RATE_LIMITER.acquire()
+        _start = time.perf_counter()
+        _response = fetch(f'{IMDB_BASE_PATH}{_row["imdb_id"]}', headers=_headers)
+        RATE_LIMITER.record(_response.status_code, time.perf_counter() - _start)
+        return _response
+
+    def refresh(self, _table, _row):
+        # returns (outcome, names of the fields that changed)
+        _imdb_id = _row['imdb_id']
+        try:
+            _response = self._fetch(_row)
+        except requests.exceptions.RequestException as e:
+            my_logger.warn(f'{_imdb_id}, refresh failed: {e!r}')
+            self._retry_later(_table, _imdb_id)
+            return 'failed', ()
+        if _response.status_code == 304:
+            self._schedule(_table, _imdb_id)
+            return 'not_modified', ()
+        if _response.status_code == 404:
+            my_logger.warn(f'{_imdb_id}, 404 page not found, checked again in {GONE_INTERVAL // DAY} days')
+            self._schedule(_table, _imdb_id, GONE_INTERVAL)
+            return 'gone', ()
+        if _response.status_code != 200:
+            self._retry_later(_table, _imdb_id)
+            return 'failed', ()
+        _html = _response.text
+        _validators = {'etag': _response.headers.get('ETag'),
+                       'last_modified': _response.headers.get('Last-Modified')}
+        # the ld+json block holds the rating and the title data without the per request noise of the page
+        _ld_json = get_ld_json_text(_html)
+        _content_hash = hashlib.sha256(_ld_json.encode('utf-8')).hexdigest() if _ld_json else None
+        if _content_hash is not None and _content_hash == _row['content_hash']:
+            self._schedule(_table, _imdb_id, **_validators)
+            return 'unchanged', ()
+        details, _fallbacks, _ = parse_html_fast(_imdb_id, _html)
+        if not details or details.TABLE_NAME != _table:
+            my_logger.warn(f'{_imdb_id}, refreshed page could not be parsed as {_table}')
+            self._retry_later(_table, _imdb_id)
+            return 'failed', ()
+        _changed = {_column: _value for _column, _value in zip(details.COLUMNS, details.insertion_values())
+                    if _column != 'imdb_id' and not _keeps_stored(_column, _row[_column], _value)}
+        self._schedule(_table, _imdb_id, _changed=bool(_changed), content_hash=_content_hash, **_validators,
+                       **_changed)
+        return ('updated' if _changed else 'unchanged'), tuple(_changed)
+
+    def run(self, max_titles=None):
+        # refreshes due titles until max_titles were checked, forever when None
+        _checked = 0
+        while max_titles is None or _checked < max_titles:
+            _limit = self.batch_size if max_titles is None else min(self.batch_size, max_titles - _checked)
+            _batch = self.due(_limit)
+            if not _batch:
+                if max_titles is not None:
+                    break
+                time.sleep(IDLE_SLEEP)
+                continue
+            for _table, _row in _batch:
+                self.stats.record(*self.refresh(_table, _row))
+            _checked += len(_batch)
+            # committed before the next due() so the same titles are not picked again
+            self._writer.flush()
+            my_logger.info(self.stats.report())
+        return self.stats
+
+    def close(self):
+        self._writer.close()
+        self._connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='refresh the stored titles in priority order')
+    parser.add_argument('--per-hour', type=int, default=DEFAULT_REQUESTS_PER_HOUR,
+                        help='maximum number of pages fetched per hour')
+    parser.add_argument('--max-titles', type=int, default=None,
+                        help='stop after checking this many titles, runs forever by default')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_TIMEOUT[0],
+                        help='seconds to wait for the connection to imdb')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_TIMEOUT[1],
+                        help='seconds to wait for a page once connected')
+    args = parser.parse_args()
+    # titles are fetched one at a time
+    configure_session(pool_size=1, timeout=(args.connect_timeout, args.read_timeout))
+    _scheduler = RefreshScheduler(requests_per_hour=args.per_hour)
+    try:
+        print(_scheduler.run(args.max_titles).report())
+    finally:
+        _scheduler.close()
@@ -0,0 +1,119 @@
+# TTL + LRU cache of serialised api responses.
+# every lookup first reads sqlite's data_version, a commit from any other connection
+# (the crawler, the scraper behind /api/{imdb_id}) empties the cache
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    # several times faster than json on lists of rows, same output for the values sqlite returns
+    import orjson
+except ImportError:
+    orjson = None
+
+
+################################################################################
+
+DEFAULT_MAX_ENTRIES = 1024
+# seconds a response is served from the cache, even without new rows
+DEFAULT_TTL = 60
+
+
+################################################################################
+
+
+def _dumps(_value):
+    if orjson is not None:
+        return orjson.dumps(_value)
+    # same output as fastapi's JSONResponse
+    return json.dumps(_value, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+def serialise_rows(_rows):
+    return _dumps([dict(_row._mapping) for _row in _rows])
+
+
+def serialise_row(_row):
+    return _dumps(dict(_row._mapping))
+
+
+class ResponseCache:
+    def __init__(self, _database_location, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.database_location = _database_location
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._data_version = None
+
+    def open(self):
+        # data_version only changes for commits made by other connections, this one never writes
+        self._connection = sqlite3.connect(self.database_location, check_same_thread=False)
+        self._data_version = self._read_data_version()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self._entries.clear()
+
+    def _read_data_version(self):
+        return self._connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def _check_data_version(self):
+        if self._connection is None:
+            return
+        _data_version = self._read_data_version()
+        if _data_version != self._data_version:
+            self._data_version = _data_version
+            self._clear()
+
+    def _clear(self):
+        if self._entries:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def get(self, _key):
+        with self._lock:
+            self._check_data_version()
+            _entry = self._entries.get(_key)
+            if _entry is None or _entry[0] <= time.monotonic():
+                if _entry is not None:
+                    del self._entries[_key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(_key)
+            self.hits += 1
+            return _entry[1]
+
+    def put(self, _key, _body):
+        # a row committed while _body was being built changes data_version, the next get drops it
+        with self._lock:
+            self._entries[_key] = (time.monotonic() + self.ttl, _body)
+            self._entries.move_to_end(_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        _lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / _lookups) if _lookups else 0.0,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+        }
@@ -1,22 +1,26 @@
 # Importing the required modules
+import argparse
 import ast
 import json
 import os
 import random
-import re
 import sqlite3
 import string
 import time
 import logging
+from collections import Counter
 
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from dataclass.imdb import Imdb, ImdbSerie, ImdbMovie
+from data.crawl_journal import CrawlJournal
 from data.imdb_id import get_imdb_ids_dump, write_imdb_id
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
+from imdb_browser import BrowserPool
+from imdb_database import DatabaseWriter, KnownIds, migrate_database
+from imdb_http import DEFAULT_TIMEOUT, FETCH_TIMINGS, configure_session, fetch
+from imdb_rate_limiter import RATE_LIMITER
+from imdb_text import IMDB_ID_PATTERN, POSTER_PATTERN, clean_plot, clean_text
 from selenium.webdriver.remote.remote_connection import LOGGER
 
 
@@ -29,103 +33,107 @@ PATH_TO_CHROME_DRIVER = os.path.join(
 
 DATABASE_LOCATION = os.path.join(CURRENT_DIR_PATH, 'database', 'imdb.db')
 
+IMDB_BASE_PATH = 'https://www.imdb.com/title/'
+
+# attempts for a page the origin throttled, the limiter backs off between them
+MAX_FETCH_ATTEMPTS = 3
+
+_JSON_DECODER = json.JSONDecoder()
+# raw_decode() does not skip the whitespace before a value
+_JSON_WHITESPACE = json.decoder.WHITESPACE
+
 LOG_LOCATION = os.path.join(CURRENT_DIR_PATH, 'data', 'imdb_scrapper.log')
 
 my_logger = logging.getLogger(__name__)
 logging.basicConfig(filename=LOG_LOCATION,
                     encoding='utf-8', level=logging.INFO)
 
+BROWSER_POOL = BrowserPool(PATH_TO_CHROME_DRIVER)
+
 
 ################################################################################
 
 
 def get_selenium_soup(_link):
-    # chrome_options for selenium
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument("--incognito")
-    chrome_options.add_argument("--disable-crash-reporter")
-    chrome_options.add_argument("--disable-extensions")
-    chrome_options.add_argument("--disable-in-process-stack-traces")
-    chrome_options.add_argument("--disable-my_logger")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--log-level=3")
-    chrome_options.add_argument("--output=/dev/null")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--disable-features=NetworkService")
-    chrome_options.add_argument("--window-size=1920x1080")
-    chrome_options.add_argument("--disable-features=VizDisplayCompositor")
-    chrome_options.headless = True
-    #selenium_service = Service(PATH_TO_CHROME_DRIVER)
-
-    browser = webdriver.Chrome(executable_path=PATH_TO_CHROME_DRIVER,
-                               options=chrome_options)
-    browser.implicitly_wait(0.1)
-    browser.get(_link)
-    # sleep to let the page load
-    time.sleep(0.5)
-    _html = browser.page_source
-    _soup = BeautifulSoup(_html.text, 'lxml')
-    browser.quit()
-    browser.close()
-    return _soup
-
-
-def get_html(_link):
+    # chrome instances are started on first use and reused across calls
+    _html = BROWSER_POOL.get_page_source(_link)
+    return BeautifulSoup(_html, 'lxml')
+
+
+def get_html(_link, _attempt=1):
+    RATE_LIMITER.acquire()
     try:
-        _html = requests.get(_link)
+        _start = time.perf_counter()
+        _html = fetch(_link)
         if _html.status_code == 404:
             my_logger.warn(f'{_link}, 404 page not found')
             return False
+        if not RATE_LIMITER.record(_html.status_code, time.perf_counter() - _start):
+            if _attempt >= MAX_FETCH_ATTEMPTS:
+                my_logger.warn(f'{_link}, still throttled after {_attempt} attempts')
+                return False
+            return get_html(_link, _attempt + 1)
         _soup = BeautifulSoup(_html.text, 'lxml')
         return _soup
     except requests.exceptions.ChunkedEncodingError:
-        time.sleep(10)
-        get_html(_link)
+        RATE_LIMITER.on_throttle('chunked encoding error')
+        if _attempt >= MAX_FETCH_ATTEMPTS:
+            return False
+        return get_html(_link, _attempt + 1)
+    except requests.exceptions.Timeout:
+        my_logger.warn(f'{_link}, request timed out')
+        return False
     except requests.exceptions.ConnectionError:
         return get_selenium_soup(_link)
 
 
-def get_media_info(_link, _sleep_timer=100):
-    soup = get_html(_link)
-    if not soup:
-        return False
-    _script = soup.find('script', type='application/ld+json')
+def get_media_info_from_soup(_soup):
+    _script = _soup.find('script', type='application/ld+json')
     _script = str(_script).replace(
         '</script>', '').replace('<script type="application/ld+json">', '')
     try:
-        media_info = json.loads(_script)
-        return soup, media_info
+        return json.loads(_script)
     except json.decoder.JSONDecodeError:
-        _sleep_timer += 20
-        if _sleep_timer >= 250:
-            my_logger.warn('Timeout, get_media_info took too long')
+        return False
+
+
+def get_media_info(_link, _attempt=1):
+    soup = get_html(_link)
+    if not soup:
+        return False
+    media_info = get_media_info_from_soup(soup)
+    if media_info:
+        return soup, media_info
+    else:
+        # imdb serves pages without the ld+json when it is throttling us
+        RATE_LIMITER.on_throttle('empty ld+json')
+        if _attempt >= MAX_FETCH_ATTEMPTS:
+            my_logger.warn(f'Timeout, get_media_info took too long, {_link}')
             return False
-        my_logger.warn(
-            f'get_media_info sleep for {_sleep_timer / 60} min, {_link}')
-        time.sleep(_sleep_timer)
-        get_media_info(_link, _sleep_timer)
+        return get_media_info(_link, _attempt + 1)
 
 
-def database_excute_command(_command, _fetch_type='none'):
+def database_excute_command(_command, _fetch_type='none', _parameters=()):
+    _connection = sqlite3.connect(DATABASE_LOCATION)
     try:
-        _connection = sqlite3.connect(DATABASE_LOCATION)
         _cursor = _connection.cursor()
         match _fetch_type.lower():
             case 'none':
-                result = _cursor.execute(_command)
+                result = _cursor.execute(_command, _parameters)
             case 'fetch_one':
-                result = _cursor.execute(_command).fetchone()
+                result = _cursor.execute(_command, _parameters).fetchone()
             case 'fetch_all':
-                result = _cursor.execute(_command).fetchall()
+                result = _cursor.execute(_command, _parameters).fetchall()
         _connection.commit()
         _cursor.close()
-        _connection.close()
         return result
     except sqlite3.Error as e:
         my_logger.warn(_command)
         my_logger.warn(e)
         return False
+    finally:
+        # a failed statement must not leave its transaction holding the database lock
+        _connection.close()
 
 
 def check_table_exists(_table_name):
@@ -156,6 +164,8 @@ def set_up_database():
         poster TEXT, rated TEXT, genre TEXT, media_type TEXT, release_date TEXT, countries TEXT, actors TEXT, creator TEXT, runtime TEXT, years TEXT, seasons TEXT)'''
         serie_details_result = database_excute_command(_sql_command)
 
+    migrate_database(DATABASE_LOCATION)
+
 
 def check_item_exists(_imdb_id):
     sql_command = f"""SELECT count(*)
@@ -179,111 +189,130 @@ def check_item_exists(_imdb_id):
 
 
 def list_to_string(_list):
-    formatted_string = _list[0]
-    formatted_string = [formatted_string.join(
-        f', {item}') for item in _list[1:]]
-    return formatted_string
+    return ', '.join(_list)
 
 
 def get_dataframe(_query):
+    # runs against the live database, analyses should load the parquet snapshot (imdb_snapshot.load_snapshot)
     connection = sqlite3.connect(DATABASE_LOCATION)
     data = pd.read_sql_query(_query, connection)
     connection.close()
     return data
 
 
-def clean_text(_text):
-    cleaned_text = _text.strip().replace('\n', '')
-    cleaned_text = cleaned_text.replace('"', '')
-    cleaned_text = cleaned_text.replace(';', '')
-    cleaned_text = cleaned_text.replace(':', '')
-    cleaned_text = cleaned_text.replace('\xa0', '')
-    cleaned_text = cleaned_text.replace('&amp;', '&')
-    cleaned_text = cleaned_text.replace('&amp', '&')
-    cleaned_text = cleaned_text.replace("""&quot""", '')
-    cleaned_text = cleaned_text.replace('&apos;', "\'")
-    cleaned_text = cleaned_text.replace('&apos', "\'")
-    cleaned_text = cleaned_text.replace('             EN', '')
-    cleaned_text = cleaned_text.replace('See full summary»', '').replace(
-        "'", '').strip()
-    return cleaned_text
+def get_imdb_id(_link):
+    return IMDB_ID_PATTERN.search(_link).group(1)
+
+
+class StrategyProfiler:
+    # time spent and success rate of every extraction strategy,
+    # on_record(strategy, elapsed, success) can be set to forward the samples elsewhere
+
+    def __init__(self, on_record=None):
+        self.on_record = on_record
+        self._calls = Counter()
+        self._successes = Counter()
+        self._total_time = Counter()
+
+    def record(self, _strategy, _elapsed, _success):
+        self._calls[_strategy] += 1
+        self._total_time[_strategy] += _elapsed
+        if _success:
+            self._successes[_strategy] += 1
+        if self.on_record is not None:
+            self.on_record(_strategy, _elapsed, _success)
+
+    def run(self, _strategy, _function, *_args):
+        _start = time.perf_counter()
+        _result = _function(*_args)
+        self.record(_strategy, time.perf_counter() - _start, bool(_result))
+        return _result
+
+    def stats(self):
+        return {_strategy: {'calls': _calls,
+                            'successes': self._successes[_strategy],
+                            'avg_ms': self._total_time[_strategy] / _calls * 1000}
+                for _strategy, _calls in self._calls.items()}
+
+    def drain(self):
+        # (strategy, calls, successes, seconds) recorded since the last drain. a process pool worker hands
+        # them back with its result, the parent merges them into its own profiler
+        _samples = [(_strategy, _calls, self._successes[_strategy], self._total_time[_strategy])
+                    for _strategy, _calls in self._calls.items()]
+        self._calls.clear()
+        self._successes.clear()
+        self._total_time.clear()
+        return _samples
+
+    def merge(self, _samples):
+        for _strategy, _calls, _successes, _total_time in _samples:
+            self._calls[_strategy] += _calls
+            self._successes[_strategy] += _successes
+            self._total_time[_strategy] += _total_time
+
+    def report(self):
+        return ', '.join(f'{_strategy}: {_stats["successes"]}/{_stats["calls"]} in {_stats["avg_ms"]:.2f} ms'
+                         for _strategy, _stats in self.stats().items()) or 'none'
+
+
+COUNTRIES_PROFILER = StrategyProfiler()
+
+
+def find_json_value(_html, _key, _start=0):
+    # decodes only the value of the first "_key": in the page, not the whole Next.js payload.
+    # whitespace is allowed around the colon, a "_key" without a colon is a string value and skipped
+    _quoted_key = f'"{_key}"'
+    _index = _html.find(_quoted_key, _start)
+    while _index != -1:
+        _colon = _JSON_WHITESPACE.match(_html, _index + len(_quoted_key)).end()
+        if _html.startswith(':', _colon):
+            try:
+                _value, _ = _JSON_DECODER.raw_decode(_html, _JSON_WHITESPACE.match(_html, _colon + 1).end())
+            except ValueError:
+                return None
+            return _value
+        _index = _html.find(_quoted_key, _index + 1)
+    return None
 
 
-def get_imdb_id(_link):
-    return re.search('https://www.imdb.com/title/(.{10}?|.{9})', _link).group(1)
-
-
-def get_countries(_soup):
-    clean_countries = []
-    _css_selectors = ['section.ipc-page-section:nth-child(28) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(32) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(33) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(34) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(35) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(36) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(37) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(40) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(41) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(44) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(45) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)',
-                      'section.ipc-page-section:nth-child(46) > div:nth-child(2) > ul:nth-child(1) > li:nth-child(2) > div:nth-child(2) > ul:nth-child(1)'
+def _countries_from_json(_html):
+    _countries_of_origin = find_json_value(_html, 'countriesOfOrigin')
+    try:
+        return [_country['text'] for _country in _countries_of_origin['countries']]
+    except (KeyError, TypeError):
+        return []
 
-                      ]
-    for _css_selector in _css_selectors:
-        try:
-            ul = _soup.select_one(_css_selector)
-            items = ul.find_all("li")
-            clean_countries = [item.text for item in items]
-            if 'Color' in clean_countries or 'Black and White' in clean_countries or '$' in clean_countries[0]:
-                clean_countries = ['NA']
-                continue
-        except AttributeError:
-            clean_countries = []
-            continue
-    if 'NA' in clean_countries or not clean_countries:
-        try:
-            countries = re.search(
-                '(?<=\"countriesOfOrigin\":{\"countries\":)(.*)(?=,\"__typename\":\"CountriesOfOrigin\"},\"detailsExternalLinks\")',
-                str(_soup)).group(1)
-            countries = ast.literal_eval(countries)
-            clean_countries = [country['text'] for country in countries]
-        except AttributeError:
-            clean_countries = ['NA']
-        except SyntaxError:
-            countries = re.search(
-                '(?<=\"countriesOfOrigin\":{\"countries\":)(.*)(?=,\"__typename\":\"CountryOfOrigin\")',
-                str(countries)).group(1)
-
-            countries = str(f'{countries}' + '}]')
-            """my_logger.info('#######################################################################')
-            my_logger.info('countries', countries)
-            my_logger.info('#######################################################################')"""
-            try:
-                countries = ast.literal_eval(countries)
-            except SyntaxError:
-                countries = re.search(
-                    '(?<=\"countriesOfOrigin\":{\"countries\":)(.*)(?=\])',
-                    str(countries)).group(1)
-                countries = str(f'{countries}' + ']')
-            try:
-                countries = ast.literal_eval(str(countries))
-                clean_countries = [country['text'] for country in countries]
-            except KeyError:
-                clean_countries = ['NA']
-            except TypeError:
-                my_logger.warn('TypeError countries', countries)
-                raise Exception('TypeError')
-            except SyntaxError:
-                my_logger.warn('SyntaxError countries', countries)
-                raise Exception('SyntaxError')
+
+def _countries_from_details(_soup):
+    # the "Country of origin" row of the details section
+    return [item.text for item in _soup.select('li[data-testid="title-details-origin"] li')]
+
+
+def _page_text(_soup):
+    # a real soup only serialises its Next.js script, LazySoup hands back the raw page
+    if isinstance(_soup, BeautifulSoup):
+        _script = _soup.find('script', id='__NEXT_DATA__')
+        if _script and _script.string:
+            return _script.string
+    return str(_soup)
+
+
+def parse_countries(_html):
+    return COUNTRIES_PROFILER.run('json', _countries_from_json, _html)
+
+
+def get_countries(_soup, _json_tried=False):
+    # _json_tried: the fast path already looked for countriesOfOrigin in the page
+    clean_countries = [] if _json_tried else parse_countries(_page_text(_soup))
+    if not clean_countries:
+        clean_countries = COUNTRIES_PROFILER.run('details_section', _countries_from_details, _soup)
     if not clean_countries:
         clean_countries = ['NA']
     return ', '.join(clean_countries)
 
 
 def get_image_full_size(_image):
-    _image = re.search(
-        '(https://m\.media-amazon\.com/images/M.*?\.)', _image).group(1)
+    _image = POSTER_PATTERN.search(_image).group(1)
     return f'{_image}jpg'
 
 
@@ -318,7 +347,8 @@ def get_poster(_media_info):
 
 def get_plot(_media_info):
     try:
-        _plot = clean_text(_media_info['description'])
+        # bound parameters, the plot no longer has to be stripped of quotes, colons and semicolons
+        _plot = clean_plot(_media_info['description'])
     except KeyError:
         _plot = 'NA'
     return _plot
@@ -449,6 +479,7 @@ def get_genres(_media_info, _soup):
 
 
 def get_voters(_media_info, _soup):
+    # None for unrated titles, stored as NULL so voters only ever holds integers
     try:
         return int(_media_info['aggregateRating']['ratingCount'])
     except KeyError:
@@ -457,9 +488,9 @@ def get_voters(_media_info, _soup):
                 'ul.ipc-metadata-list:nth-child(4) > li:nth-child(2) > div:nth-child(2)')
             return int(_div.text)
         except AttributeError:
-            return 'NA'
+            return None
         except ValueError:
-            return 'NA'
+            return None
 
 
 def get_release_date(_media_info, _soup):
@@ -498,32 +529,53 @@ def get_details(_link):
         return False
     if not media_info:
         return False
+    return extract_details(imdb_id, soup, media_info)
+
+
+def parse_html(_imdb_id, _html):
+    # parse an already fetched page, used by the crawl pipeline in imdb_crawler
+    soup = BeautifulSoup(_html, 'lxml')
+    media_info = get_media_info_from_soup(soup)
+    if not media_info:
+        return False
+    return extract_details(_imdb_id, soup, media_info)
+
+
+def _prefer(_fast_values, _field, _getter, *_args):
+    # value found by the imdb_extract fast path, or the soup based getter when it is missing
+    _value = _fast_values.get(_field) if _fast_values else None
+    if _value is not None:
+        return _value
+    return _getter(*_args)
+
+
+def extract_details(imdb_id, soup, media_info, fast_values=None):
     media_type = media_info['@type']
     if 'TVEpisode' in media_type:
         my_logger.info(f'{imdb_id}: {media_type} Skipped')
         return False
-    title = get_title(soup)
+    title = _prefer(fast_values, 'title', get_title, soup)
     original_title = clean_text(media_info['name'])
-    voters = get_voters(media_info, soup)
-    rated = get_rated(media_info, soup)
-    release_date = get_release_date(media_info, soup)
+    voters = _prefer(fast_values, 'voters', get_voters, media_info, soup)
+    rated = _prefer(fast_values, 'rated', get_rated, media_info, soup)
+    release_date = _prefer(fast_values, 'release_date', get_release_date, media_info, soup)
     poster = get_poster(media_info)
-    countries = get_countries(soup)
+    countries = _prefer(fast_values, 'countries', get_countries, soup, 'countries' in (fast_values or {}))
     score = get_score(media_info)
     plot = get_plot(media_info)
-    genre = get_genres(media_info, soup)
+    genre = _prefer(fast_values, 'genre', get_genres, media_info, soup)
 
     match media_type:
         case 'TVSeries':
             media_type = 'TV Series'
-            actors = get_actors(soup, True)
-            seasons = get_seasons(soup)
-            runtime = get_series_runtime(soup)
-            years = get_series_years(soup)
+            actors = _prefer(fast_values, 'actors', get_actors, soup, True)
+            seasons = _prefer(fast_values, 'seasons', get_seasons, soup)
+            runtime = _prefer(fast_values, 'runtime', get_series_runtime, soup)
+            years = _prefer(fast_values, 'years', get_series_years, soup)
             try:
                 creator = clean_creator(media_info['creators'])
             except KeyError:
-                creator = get_creators(soup)
+                creator = _prefer(fast_values, 'creator', get_creators, soup)
             if release_date == 'NA':
                 if years != 'NA':
                     release_date = years.split('-')[0]
@@ -533,11 +585,11 @@ def get_details(_link):
                                    seasons)
             return imdb_serie
         case 'Movie':
-            actors = get_actors(soup)
+            actors = _prefer(fast_values, 'actors', get_actors, soup)
             try:
                 director = clean_creator(media_info['directors'])
             except KeyError:
-                director = get_creators(soup)
+                director = _prefer(fast_values, 'director', get_creators, soup)
             try:
                 runtime = media_info['duration'].replace(
                     'PT', '').replace('H', 'h').replace('M', 'm').lower()
@@ -551,8 +603,8 @@ def get_details(_link):
 
 
 def add_to_database(_media: Imdb):
-    _insert_command = _media.insertion_command()
-    return database_excute_command(_insert_command)
+    _insert_command, _parameters = _media.insertion_parameters()
+    return database_excute_command(_insert_command, _parameters=_parameters)
 
 
 def update_media(_reddit_goal, _table_name):
@@ -571,25 +623,6 @@ def show_all():
     connection.close()
 
 
-def mongodb_format():
-    connection = sqlite3.connect(DATABASE_LOCATION)
-    _cursor = connection.cursor()
-    # This enables column access by name: row['column_name']
-    connection.row_factory = sqlite3.Row
-    _rows = _cursor.execute(
-        f''' SELECT * from movie_details inner join serie_details on movie_details.title = serie_details.title''').fetchall()
-    connection.commit()
-    with open('data.json', 'a+') as outfile:
-        for _row in _rows:
-            imdb_movie = dict(
-                (_cursor.description[i][0], value) for i, value in enumerate(_row))
-            imdb_movie['_class'] = 'com.back_sync.models.Imdb'
-            json.dump(imdb_movie, outfile)
-            outfile.write('\n')
-    _cursor.close()
-    connection.close()
-
-
 def get_json_data(_imdb_id):
     connection = sqlite3.connect(DATABASE_LOCATION)
     _cursor = connection.cursor()
@@ -640,73 +673,85 @@ def temp_id_list():
         write_imdb_id(ast.literal_eval(f'[{strint_to_write}]'))
 
 
-def single_scrape(imdb_id):
-    set_up_database()
-    imdb_base_path = 'https://www.imdb.com/title/'
-    details = get_details(f'{imdb_base_path}{imdb_id}')
+def scrape_and_store(imdb_id):
+    # the schema must already exist, callers that run often set it up once at startup
+    insertion_details = False
+    details = get_details(f'{IMDB_BASE_PATH}{imdb_id}')
     if details:
         insertion_details = add_to_database(details)
     if insertion_details:
         my_logger.info(f'{details.title} Added to database')
 
 
-def main(imdb_ids):
-    imdb_base_path = 'https://www.imdb.com/title/'
+def single_scrape(imdb_id):
+    set_up_database()
+    scrape_and_store(imdb_id)
+
+
+def main(imdb_ids, timeout=DEFAULT_TIMEOUT):
     # id_test = ['tt1345836', 'tt0482571', 'tt1375666', 'tt2084970', 'tt0756683']
     # id_test = ['tt0002610', 'tt0372784', 'tt0903747']
     # id_test = ['tt0172495', 'tt0107290', 'tt0046912']
     loop_counter = 1
     _movies_added = 0
     _series_added = 0
-    _database_counter = 0
-    _programe_pause_counter = 0
     _list_original_lenght = len(imdb_ids)
+    # one page at a time, a single keep-alive connection is enough
+    configure_session(pool_size=1, timeout=timeout)
     set_up_database()
-    for imdb_id in imdb_ids[:]:
-        insertion_details = False
-        if _programe_pause_counter >= 1000:
-            my_logger.warn('Program paused for 2 min')
-            time.sleep(120)
-            my_logger.warn('Program restarting')
-            _programe_pause_counter = 0
-        if _database_counter >= 20:
-            write_imdb_id(imdb_ids)
-            _database_counter = 0
-        start_time = time.time()
-        my_logger.info(imdb_id)
-        my_logger.info(
-            f'{loop_counter}/{_list_original_lenght} - movies added: {_movies_added}, series added: {_series_added}')
-        _item = check_item_exists(imdb_id)
-        if _item:
-            my_logger.info(f'{_item} found')
-            imdb_ids.remove(imdb_id)
-        else:
-            details = get_details(f'{imdb_base_path}{imdb_id}')
-            if details:
-                match details.media_type:
-                    case 'TV Series':
-                        insertion_details = add_to_database(details)
-                        _series_added += 1
-                        _programe_pause_counter += 1
-                    case 'Movie':
-                        insertion_details = add_to_database(details)
-                        _movies_added += 1
-                        _programe_pause_counter += 1
-                    case _:
-                        my_logger.warn('Unknown type', details.type)
-            else:
-                imdb_ids.remove(imdb_id)
+    _known_ids = KnownIds(DATABASE_LOCATION)
+    # progress is appended to the journal, the id list is never modified or rewritten
+    _journal = CrawlJournal()
+    my_logger.info(f'crawl journal replayed: {_journal.counts}')
 
-            if insertion_details:
-                my_logger.info(f'{details.title} Added to database')
-                imdb_ids.remove(imdb_id)
+    def _on_commit(_rows):
+        _known_ids.on_commit(_rows)
+        _journal.on_commit(_rows)
 
-        loop_counter += 1
-        _database_counter += 1
-        my_logger.info(f"--- {(time.time() - start_time)} seconds ---")
+    # rows are committed in batches on the writer thread, an id is journaled as done once its row is committed
+    _writer = DatabaseWriter(DATABASE_LOCATION, on_commit=_on_commit)
+    try:
+        for imdb_id in _journal.pending(imdb_ids):
+            start_time = time.time()
+            my_logger.info(imdb_id)
+            my_logger.info(
+                f'{loop_counter}/{_list_original_lenght} - movies added: {_movies_added}, series added: {_series_added}, '
+                f'fetch: {FETCH_TIMINGS.stats()}, {RATE_LIMITER.report()}, countries: {COUNTRIES_PROFILER.report()}')
+            if imdb_id in _known_ids:
+                my_logger.info(f'{imdb_id} found')
+                _journal.skipped(imdb_id)
+            else:
+                details = get_details(f'{IMDB_BASE_PATH}{imdb_id}')
+                if details:
+                    match details.media_type:
+                        case 'TV Series':
+                            _writer.add(details)
+                            _series_added += 1
+                            my_logger.info(f'{details.title} Added to database')
+                        case 'Movie':
+                            _writer.add(details)
+                            _movies_added += 1
+                            my_logger.info(f'{details.title} Added to database')
+                        case _:
+                            my_logger.warn(f'Unknown type {details.media_type}')
+                else:
+                    _journal.failed(imdb_id)
+
+            loop_counter += 1
+            my_logger.info(f"--- {(time.time() - start_time)} seconds ---")
+    finally:
+        # flushes the rows still queued, their ids are journaled before the journal closes
+        _writer.close()
+        _journal.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sequential imdb scrapper')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_TIMEOUT[0],
+                        help='seconds to wait for the connection to imdb')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_TIMEOUT[1],
+                        help='seconds to wait for a page once connected')
+    args = parser.parse_args()
     imdb_ids = get_imdb_ids_dump()
-    main(imdb_ids)
+    main(imdb_ids, (args.connect_timeout, args.read_timeout))
     # temp_id_list()
@@ -0,0 +1,154 @@
+# Columnar snapshots of the media tables for analytics.
+# the database is read once per snapshot, the analyses then load only the parquet columns they need
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from imdb_database import MEDIA_KINDS, MEDIA_TABLES, media_projection
+from imdb_scrapper import DATABASE_LOCATION
+
+
+################################################################################
+
+CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# hive partitioned by kind: snapshot/kind=movie/part-0.parquet, snapshot/kind=serie/part-0.parquet
+SNAPSHOT_PATH = os.path.join(CURRENT_DIR_PATH, 'data', 'snapshot')
+# rows read from sqlite and written as one parquet row group
+DEFAULT_BATCH_SIZE = 50000
+
+_DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+# every partition uses the media view columns, the columns of the other kind are null
+SNAPSHOT_SCHEMA = pa.schema([
+    ('imdb_id', pa.string()),
+    ('title', pa.string()),
+    ('original_title', pa.string()),
+    ('score', pa.float32()),
+    ('voters', pa.int64()),
+    ('plot', pa.string()),
+    ('poster', pa.string()),
+    # few distinct values, dictionary encoded in the file and loaded as categories
+    ('rated', _DICTIONARY),
+    ('genre', _DICTIONARY),
+    ('media_type', _DICTIONARY),
+    ('release_date', pa.string()),
+    ('countries', _DICTIONARY),
+    ('actors', pa.string()),
+    ('director', pa.string()),
+    ('runtime', pa.string()),
+    ('creator', pa.string()),
+    ('years', pa.string()),
+    ('seasons', pa.int16()),
+    ('release_year', pa.int16()),
+    ('primary_country', _DICTIONARY),
+    ('scraped_at', pa.timestamp('s')),
+])
+
+my_logger = logging.getLogger(__name__)
+
+
+################################################################################
+
+
+def _to_number(_value, _cast):
+    # legacy rows hold '' or text where a number is expected
+    if _value is None or _value == '':
+        return None
+    try:
+        return _cast(_value)
+    except (TypeError, ValueError):
+        return None
+
+
+_CONVERTERS = {
+    'score': float,
+    'voters': int,
+    'seasons': int,
+    'release_year': int,
+    'scraped_at': int,
+}
+
+
+def _record_batch(_rows, _positions):
+    _arrays = []
+    for _field in SNAPSHOT_SCHEMA:
+        _index = _positions[_field.name]
+        _values = [_row[_index] for _row in _rows]
+        _cast = _CONVERTERS.get(_field.name)
+        if _cast is not None:
+            _values = [_to_number(_value, _cast) for _value in _values]
+        _arrays.append(pa.array(_values, type=_field.type))
+    return pa.RecordBatch.from_arrays(_arrays, schema=SNAPSHOT_SCHEMA)
+
+
+def _write_table(_connection, _table, _partition_path, _batch_size):
+    os.makedirs(_partition_path)
+    _cursor = _connection.execute(f'SELECT {media_projection(_table)} FROM {_table}')
+    # the kind column is left out, it is the partition key
+    _positions = {_column[0]: _index for _index, _column in enumerate(_cursor.description)}
+    _rows_written = 0
+    with pq.ParquetWriter(os.path.join(_partition_path, 'part-0.parquet'), SNAPSHOT_SCHEMA,
+                          compression='zstd') as writer:
+        while True:
+            _rows = _cursor.fetchmany(_batch_size)
+            if not _rows:
+                break
+            writer.write_batch(_record_batch(_rows, _positions), row_group_size=_batch_size)
+            _rows_written += len(_rows)
+    _cursor.close()
+    return _rows_written
+
+
+def write_snapshot(database_location=DATABASE_LOCATION, snapshot_path=SNAPSHOT_PATH, batch_size=DEFAULT_BATCH_SIZE):
+    # written next to the current snapshot and swapped in once complete, loaders never see half a snapshot
+    _start = time.perf_counter()
+    _temp_path = f'{snapshot_path}.tmp'
+    shutil.rmtree(_temp_path, ignore_errors=True)
+    _rows = {}
+    # read only, one transaction: both tables come from the same state of the database
+    _connection = sqlite3.connect(f'file:{database_location}?mode=ro', uri=True)
+    try:
+        _connection.execute('BEGIN')
+        for _table in MEDIA_TABLES:
+            _partition_path = os.path.join(_temp_path, f'kind={MEDIA_KINDS[_table]}')
+            _rows[_table] = _write_table(_connection, _table, _partition_path, batch_size)
+        _connection.rollback()
+    finally:
+        _connection.close()
+    _old_path = f'{snapshot_path}.old'
+    shutil.rmtree(_old_path, ignore_errors=True)
+    if os.path.isdir(snapshot_path):
+        os.replace(snapshot_path, _old_path)
+    os.replace(_temp_path, snapshot_path)
+    shutil.rmtree(_old_path, ignore_errors=True)
+    _elapsed = time.perf_counter() - _start
+    _size = sum(os.path.getsize(os.path.join(_root, _name))
+                for _root, _, _names in os.walk(snapshot_path) for _name in _names)
+    _report = (f'snapshot written to {snapshot_path} in {_elapsed:.1f} s, '
+               f'{", ".join(f"{_table}: {_count}" for _table, _count in _rows.items())}, {_size / 2 ** 20:.1f} MB')
+    my_logger.info(_report)
+    return _report
+
+
+def load_snapshot(columns=None, kind=None, snapshot_path=SNAPSHOT_PATH, as_arrow=False):
+    # only the requested columns are read from the files, kind ('movie' or 'serie') skips the other partition.
+    # dictionary columns come back as pandas categories
+    _filters = [('kind', '=', kind)] if kind is not None else None
+    _table = pq.read_table(snapshot_path, columns=list(columns) if columns is not None else None, filters=_filters,
+                           partitioning='hive')
+    if as_arrow:
+        return _table
+    return _table.to_pandas()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write a parquet snapshot of the movies and series')
+    parser.add_argument('--output', default=SNAPSHOT_PATH, help='directory of the snapshot')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='rows read from sqlite and written as one row group')
+    args = parser.parse_args()
+    print(write_snapshot(snapshot_path=args.output, batch_size=args.batch_size))